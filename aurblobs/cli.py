@@ -1,21 +1,31 @@
 import os
 import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from contextlib import ExitStack
 from pathlib import Path
 import click
 from tempfile import TemporaryDirectory
 
 from . import __VERSION__
 from .constants import (
-    CONFIG_DIR, CACHE_DIR, PACMAN_SYNC_CACHE_DIR, PROJECT_NAME
+    BUILD_CACHE_DIR, CONFIG_DIR, CACHE_DIR, DAEMON_SOCKET, INDEX_DIR,
+    PACMAN_SYNC_CACHE_DIR, PROJECT_NAME
 )
-from .container import update_build_container
+from .container import update_build_container, sync_databases
+from .daemon import Daemon, PRIORITY_MANUAL, request
+from .errors import LockError
+from .nodes import NodePool
+from .planner import estimate, format_duration, makespan, order
 from .repository import Repository
+from .trace import profiler, tracer
 
 if os.geteuid() == 0:
     click.echo("Don't run aurblobs as root!", file=sys.stderr)
     sys.exit(1)
 
-for directory in [CONFIG_DIR, CACHE_DIR, PACMAN_SYNC_CACHE_DIR]:
+for directory in [CONFIG_DIR, CACHE_DIR, PACMAN_SYNC_CACHE_DIR,
+                  BUILD_CACHE_DIR, INDEX_DIR]:
     try:
         os.mkdir(directory)
     except FileExistsError:
@@ -34,6 +44,36 @@ def is_valid_repository(ctx, param, value):
     return None
 
 
+def traceable(command):
+    # tracing and profiling are started by eager options, so they already
+    # cover the callbacks of the other options, e.g. loading repositories
+    def trace(ctx, param, value):
+        if value and not ctx.resilient_parsing:
+            tracer.enable()
+            stack = ExitStack()
+            stack.callback(tracer.save, value)
+            stack.enter_context(tracer.span(command.__name__))
+            ctx.call_on_close(stack.close)
+
+    def profile(ctx, param, value):
+        if value and not ctx.resilient_parsing:
+            profiler.enable()
+            stack = ExitStack()
+            stack.callback(profiler.dump)
+            stack.enter_context(profiler.thread())
+            ctx.call_on_close(stack.close)
+
+    command = click.option(
+        '--profile', is_flag=True, default=False, is_eager=True,
+        expose_value=False, callback=profile,
+        help='Profile the run and print statistics.')(command)
+    command = click.option(
+        '--trace', type=click.Path(dir_okay=False), is_eager=True,
+        expose_value=False, callback=trace,
+        help='Write a Chrome trace event timeline to FILE.')(command)
+    return command
+
+
 @click.group()
 @click.version_option(prog_name=PROJECT_NAME, version=__VERSION__)
 def cli():
@@ -45,8 +85,6 @@ def cli():
 @click.argument('basedir')
 @click.argument('mail')
 def init(repository, basedir, mail):
-    update_build_container()
-
     _repository = Repository()
     _repository.create(repository, basedir, mail)
 
@@ -61,6 +99,7 @@ def drop(repository):
 
 
 @click.command(short_help='Add a new package to an existing repository.')
+@traceable
 @click.option('--repository', callback=is_valid_repository)
 @click.argument('package', nargs=-1, required=True)
 def add(package, repository=None):
@@ -78,6 +117,7 @@ def add(package, repository=None):
 
 
 @click.command(short_help='Remove a package from a repository')
+@traceable
 @click.option('--repository', callback=is_valid_repository)
 @click.argument('package', nargs=-1, required=True)
 def remove(repository, package):
@@ -90,8 +130,6 @@ def remove(repository, package):
             sys.exit(1)
         repository = Repository(available_repositories[0])
 
-    update_build_container()
-
     # TODO: Implementation missing
     for pkg in package:
         repository.remove_and_sign(pkg)
@@ -121,37 +159,230 @@ def _list(repository):
                     click.echo('   - {0} ({1})'.format(
                         pkg, pkginfo['version']))
 
+            if package.failures:
+                click.echo('   failed to build {0} times{1}'.format(
+                    package.failures['count'],
+                    ', {0}'.format(package.failures['reason'])
+                    if package.failures.get('reason') else ''))
+
 
 @click.command(short_help='Update packages in repository to latest version.')
+@traceable
 @click.option('--repository', callback=is_valid_repository)
 @click.option('--force', is_flag=True, default=False,
               help='Bypass up-to-date check.')
+@click.option('--retry-failed', is_flag=True, default=False,
+              help='Retry failed packages and their dependents right away.')
 @click.option('--jobs', type=int, help='Number of jobs to run builds with.')
+@click.option('--prefetch', type=int, default=2, show_default=True,
+              help='Number of packages to fetch sources for ahead of their '
+                   'build.')
+@click.option('--resume', is_flag=True, default=False,
+              help='Continue packages an interrupted run left behind.')
+@click.option('--plan', is_flag=True, default=False,
+              help='Only show which packages would be rebuilt and how long '
+                   'that is going to take.')
+@click.option('--parallel', type=int,
+              help='Number of concurrent builds to estimate the run time '
+                   'for, defaults to the capacity of all build nodes.')
 @click.argument('package', nargs=-1)
-def update(repository, force, jobs, package):
+def update(repository, force, retry_failed, jobs, prefetch, resume, plan,
+           parallel, package):
     if repository:
         repositories = [repository]
     else:
         repositories = [Repository(name) for name in available_repositories]
 
-    update_build_container()
+    if plan:
+        plan_repositories(repositories, force, parallel, package)
+        return
 
-    with TemporaryDirectory(prefix=PROJECT_NAME, suffix='pkgs') as pkgcache:
+    with ExitStack() as stack:
+        locked = []
         for repository in repositories:
-            if package:
-                pkgs = {repository.find_package(p) for p in package}
-            else:
-                pkgs = repository.packages
-
-            for pkg in pkgs:
-                pkg.update(
-                    force=force,
-                    buildopts=dict(
-                        jobs=jobs,
-                        pkgcache=pkgcache
-                    )
+            try:
+                stack.enter_context(repository.updating())
+            except LockError:
+                click.echo(
+                    '{0}: skipped, another update is running'.format(
+                        repository.name),
+                    file=sys.stderr
                 )
-                repository.save()
+                continue
+
+            # pick up the state left behind by a run that just finished
+            locked.append(Repository(repository.name))
+
+        if locked:
+            build_repositories(
+                locked, force, retry_failed, jobs, prefetch, resume, package)
+
+
+def selected_packages(repositories, package):
+    pkgs = []
+    for repository in repositories:
+        if package:
+            pkgs.extend({repository.find_package(p) for p in package})
+        else:
+            pkgs.extend(repository.packages)
+    return pkgs
+
+
+def plan_repositories(repositories, force, parallel, package):
+    if not parallel:
+        parallel = NodePool.load().capacity
+
+    pkgs = selected_packages(repositories, package)
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        heads = list(executor.map(lambda pkg: pkg.remote_head(), pkgs))
+
+    rebuild = [pkg for pkg, head in zip(pkgs, heads)
+               if pkg.needs_rebuild(head, force)]
+    ordered, deps = order(rebuild)
+
+    click.echo('{0} packages to rebuild, in build order:'.format(
+        len(ordered)))
+    for pkg in ordered:
+        click.echo(' - {0} ({1}{2})'.format(
+            pkg.fullname, format_duration(estimate(pkg)),
+            '' if pkg.durations else ', not built before'))
+
+    click.echo('estimated run time with {0} concurrent builds: {1}'.format(
+        parallel, format_duration(makespan(ordered, deps, parallel))))
+
+
+def build_repositories(repositories, force, retry_failed, jobs, prefetch,
+                       resume, package):
+    pool = NodePool.load()
+    for node in pool.nodes:
+        with tracer.span('update build container', node=node.name):
+            update_build_container(node)
+    snapshot = ExitStack()
+    with tracer.span('refresh sync databases'):
+        syncdir = snapshot.enter_context(sync_databases(pool.nodes[0]))
+
+    def build(repository, pkg, pkgcache, required):
+        # dependencies are built first, so their new version gets used
+        wait(required)
+
+        with profiler.thread(), tracer.span('update', package=pkg.fullname):
+            pkg.update(
+                force=force,
+                retry_failed=retry_failed,
+                pool=pool,
+                prefetch=prefetch > 0,
+                resume=resume,
+                buildopts=dict(
+                    jobs=jobs,
+                    pkgcache=pkgcache,
+                    syncdir=syncdir
+                )
+            )
+            repository.save(config=False)
+
+    # workers beyond the build capacity fetch sources of upcoming packages
+    # and wait for a build slot to free up
+    workers = pool.capacity + max(prefetch, 0)
+    with snapshot, \
+            TemporaryDirectory(prefix=PROJECT_NAME, suffix='pkgs') as pkgcache, \
+            ThreadPoolExecutor(max_workers=workers) as executor:
+        # longest builds first, after the packages they depend on. Builds
+        # only wait for packages submitted before them, which rules out
+        # deadlocks on dependency cycles.
+        ordered, deps = order(selected_packages(repositories, package))
+
+        futures = {}
+        for pkg in ordered:
+            required = [futures[dep] for dep in deps[pkg] if dep in futures]
+            futures[pkg] = executor.submit(
+                build, pkg.repository, pkg, pkgcache, required)
+
+        for future in futures.values():
+            future.result()
+
+
+@click.command(short_help='Keep building packages in the background.')
+@click.option('--interval', type=int, default=3600, show_default=True,
+              help='Seconds between checking AUR for updates.')
+@click.option('--jitter', type=int, default=600, show_default=True,
+              help='Maximum random delay added to the interval.')
+@click.option('--jobs', type=int, help='Number of jobs to run builds with.')
+@click.option('--prefetch', type=int, default=2, show_default=True,
+              help='Number of packages to fetch sources for ahead of their '
+                   'build.')
+@click.option('--socket', 'socket_path', default=DAEMON_SOCKET,
+              show_default=True, help='Path of the control socket.')
+def daemon(interval, jitter, jobs, prefetch, socket_path):
+    Daemon(socket_path, interval, jitter, jobs, prefetch).run()
+
+
+def daemon_request(socket_path, payload):
+    try:
+        response = request(socket_path, payload)
+    except OSError as ex:
+        click.echo(
+            'Unable to reach daemon at {0}, is it running?\n{1}'.format(
+                socket_path, ex),
+            file=sys.stderr
+        )
+        sys.exit(1)
+
+    if 'error' in response:
+        click.echo(response['error'], file=sys.stderr)
+        sys.exit(1)
+
+    return response
+
+
+@click.command(short_help='Queue package builds with a running daemon.')
+@click.option('--repository', callback=is_valid_repository)
+@click.option('--force', is_flag=True, default=False,
+              help='Bypass up-to-date check.')
+@click.option('--priority', type=int, default=PRIORITY_MANUAL,
+              show_default=True, help='Higher priorities are built first.')
+@click.option('--socket', 'socket_path', default=DAEMON_SOCKET,
+              show_default=True, help='Path of the control socket.')
+@click.argument('package', nargs=-1, required=True)
+def enqueue(repository, force, priority, socket_path, package):
+    if not repository:
+        if len(available_repositories) != 1:
+            click.echo(
+                "Repository ambiguous, specify one with --repository.",
+                file=sys.stderr
+            )
+            sys.exit(1)
+        repository = Repository(available_repositories[0])
+
+    response = daemon_request(socket_path, {
+        'command': 'enqueue',
+        'repository': repository.name,
+        'packages': list(package),
+        'priority': priority,
+        'force': force,
+    })
+    click.echo('{0} jobs queued'.format(response['queued']))
+
+
+@click.command(short_help='Show queued and running builds of the daemon.')
+@click.option('--socket', 'socket_path', default=DAEMON_SOCKET,
+              show_default=True, help='Path of the control socket.')
+def status(socket_path):
+    response = daemon_request(socket_path, {'command': 'status'})
+
+    click.echo('running ({0}):'.format(len(response['running'])))
+    for job in response['running']:
+        click.echo(' - {0}/{1} on {2} (since {3}s)'.format(
+            job['repository'], job['package'], job['node'] or 'no node yet',
+            int(time.time()) - job['started']))
+
+    click.echo('queued ({0}):'.format(response['queued']))
+    for job in response['queue']:
+        click.echo(' - {0}/{1} (priority {2})'.format(
+            job['repository'], job['package'], job['priority']))
+
+    if response['next_poll']:
+        click.echo('next poll in {0}s'.format(
+            max(0, response['next_poll'] - int(time.time()))))
 
 
 cli.add_command(init)
@@ -160,6 +391,9 @@ cli.add_command(add)
 cli.add_command(remove)
 cli.add_command(_list)
 cli.add_command(update)
+cli.add_command(daemon)
+cli.add_command(enqueue)
+cli.add_command(status)
 
 
 if __name__ == '__main__':
@@ -9,5 +9,40 @@ CACHE_DIR = os.path.join(xdg_cache_home, PROJECT_NAME)
 
 PACMAN_SYNC_CACHE_DIR = os.path.join(CACHE_DIR, 'sync')
 
+# indexes and queues of aurblobs itself, kept apart from the repository
+# states in CACHE_DIR, that are named after their repository
+INDEX_DIR = os.path.join(CACHE_DIR, 'index')
+
+# build directories of packages, kept until they are published, so
+# interrupted update runs can be resumed
+BUILD_CACHE_DIR = os.path.join(CACHE_DIR, 'builds')
+
+# keyring verifying sources against the validpgpkeys of PKGBUILDs, shared
+# by all builds, and when its keys were last received
+PGP_KEYRING_DIR = os.path.join(CACHE_DIR, 'keyring')
+PGP_KEYRING_INDEX = os.path.join(INDEX_DIR, 'keyring.json')
+# keys are refreshed in the background after this many seconds
+PGP_KEY_TTL = 7 * 86400
+PGP_KEYSERVER = 'hkps://keyserver.ubuntu.com'
+
+# docker daemons to distribute builds across, in JSON. It must not end in
+# .json, as those files are taken for repository configurations.
+NODES_FILE = os.path.join(CONFIG_DIR, 'nodes.conf')
+
+DAEMON_SOCKET = os.path.join(CACHE_DIR, 'daemon.sock')
+DAEMON_QUEUE_FILE = os.path.join(INDEX_DIR, 'queue.json')
+
 DOCKER_IMAGE = 'aurblobs/build:{version}'.format(version=PROJECT_VERSION)
 DOCKER_BASE_IMAGE = 'aurblobs/arch-multilib:latest'
+
+# derived build images with preinstalled package dependencies
+DOCKER_DEPENDENCY_IMAGE = 'aurblobs/deps'
+DOCKER_DEPENDENCY_INDEX = os.path.join(INDEX_DIR, 'images.json')
+# maximum number of dependency images kept, least recently used go first
+DOCKER_DEPENDENCY_IMAGE_LIMIT = 24
+# dependency images are rebuilt regularly to not build against stale packages
+DOCKER_DEPENDENCY_IMAGE_MAX_AGE = 7 * 86400
+
+# time after which helper containers (sync refresh, dependency images) are
+# considered hung and killed
+DOCKER_HELPER_TIMEOUT = 3600
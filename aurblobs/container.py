@@ -1,22 +1,87 @@
+import datetime
+import hashlib
+import json
 import os
 import sys
+import threading
+import time
+import uuid
+from contextlib import ExitStack, contextmanager
+from shutil import rmtree
+from tempfile import mkdtemp
 
 import click
-import docker
 from docker.errors import BuildError, APIError, ImageNotFound
 
-from .constants import DOCKER_IMAGE, DOCKER_BASE_IMAGE
+from .constants import (
+    DOCKER_IMAGE, DOCKER_BASE_IMAGE, DOCKER_DEPENDENCY_IMAGE,
+    DOCKER_DEPENDENCY_INDEX, DOCKER_DEPENDENCY_IMAGE_LIMIT,
+    DOCKER_DEPENDENCY_IMAGE_MAX_AGE, DOCKER_HELPER_TIMEOUT,
+    PACMAN_SYNC_CACHE_DIR, PROJECT_NAME
+)
+from .errors import LockError
+from .utils import atomic_json_dump, file_lock
 
 
-def need_rebuild():
-    client = docker.from_env()
+def follow(container, tail=None, timeout=None, stall_timeout=None):
+    # print the log of a running container until it exits. A watchdog kills
+    # the container once it exceeds its wall-clock timeout or stops producing
+    # output for stall_timeout seconds. Returns whether it exited
+    # successfully and the reason it was killed, if it was.
+    start = last = time.monotonic()
+    reason = None
+    done = threading.Event()
+
+    def watch():
+        nonlocal reason
+        while not done.wait(1):
+            now = time.monotonic()
+            if timeout and now - start > timeout:
+                reason = 'timed out after {0}s'.format(timeout)
+            elif stall_timeout and now - last > stall_timeout:
+                reason = 'stalled, no output for {0}s'.format(stall_timeout)
+            else:
+                continue
+
+            try:
+                container.kill()
+            except APIError:
+                # exited in the meantime
+                pass
+            return
+
+    if timeout or stall_timeout:
+        threading.Thread(target=watch, daemon=True).start()
+
+    try:
+        for line in container.logs(stream=True):
+            last = time.monotonic()
+            line = line.decode().rstrip('\n')
+            if tail is not None:
+                tail.append(line)
+            print('\t{0}'.format(line))
+
+        status = container.wait()['StatusCode']
+    finally:
+        done.set()
+
+    if reason:
+        click.echo('Container {0} {1}, killed'.format(container.name, reason),
+                   file=sys.stderr)
+
+    return status == 0 and not reason, reason
+
+
+def need_rebuild(node):
+    client = node.client
 
     # base image does not exist
     try:
         baseimage = client.images.get(DOCKER_BASE_IMAGE)
     except ImageNotFound:
         click.echo(
-            'Build container rebuild necessary: base layer missing'
+            '{0}: build container rebuild necessary: base layer '
+            'missing'.format(node.name)
         )
         return True
 
@@ -24,7 +89,8 @@ def need_rebuild():
     baseimage_new = client.images.pull(DOCKER_BASE_IMAGE)
     if baseimage.id != baseimage_new.id:
         click.echo(
-            'Build container rebuild necessary: base layer update available'
+            '{0}: build container rebuild necessary: base layer update '
+            'available'.format(node.name)
         )
         return True
 
@@ -33,7 +99,8 @@ def need_rebuild():
         image = client.images.get(DOCKER_IMAGE)
     except ImageNotFound:
         click.echo(
-            'Image for build container not found, need to build it'
+            '{0}: image for build container not found, need to build '
+            'it'.format(node.name)
         )
         return True
 
@@ -48,33 +115,43 @@ def need_rebuild():
 
     if not baselayer_found:
         click.echo(
-            'Build container rebuild required: base layer update available'
+            '{0}: build container rebuild required: base layer update '
+            'available'.format(node.name)
         )
         return True
 
     # build image outdated
     if DOCKER_IMAGE not in image.tags:
         click.echo(
-            'Build container rebuild required: matching tag was not found'
+            '{0}: build container rebuild required: matching tag was not '
+            'found'.format(node.name)
         )
         return True
 
     return False
 
 
-def update_build_container():
-    if not need_rebuild():
+def build_image_id(node):
+    try:
+        return node.client.images.get(DOCKER_IMAGE).id
+    except ImageNotFound:
+        return None
+
+
+def update_build_container(node):
+    # image freshness is tracked separately on every build node
+    if not need_rebuild(node):
         return
 
-    client = docker.from_env()
     try:
-        image, response = client.images.build(
+        image, response = node.client.images.build(
             path=os.path.join(os.path.dirname(__file__), 'docker'),
             tag=DOCKER_IMAGE,
             pull=True,
         )
 
-        click.echo('Image {image} updated'.format(image=image.tags[0]))
+        click.echo('{node}: image {image} updated'.format(
+            node=node.name, image=image.tags[0]))
 
     except BuildError as ex:
         click.echo('Error while building the container: {}'.format(ex))
@@ -82,3 +159,240 @@ def update_build_container():
     except APIError as ex:
         click.echo('Error communicating with your docker daemon: {}'.format(ex))
         sys.exit(2)
+
+
+@contextmanager
+def package_cache(pkgcache):
+    # containers only read the shared package cache and download into a
+    # cache of their own, so concurrent downloads of the same package don't
+    # write the same file. Downloads are moved into the shared cache once
+    # the container is done.
+    if not pkgcache:
+        yield {}
+        return
+
+    private = mkdtemp(prefix='{0}.'.format(os.path.basename(pkgcache)),
+                      dir=os.path.dirname(pkgcache))
+    try:
+        yield {
+            private: {'bind': '/var/cache/pacman/pkg', 'mode': 'rw'},
+            pkgcache: {'bind': '/var/cache/pacman/shared', 'mode': 'ro'},
+        }
+    finally:
+        for entry in os.listdir(private):
+            path = os.path.join(private, entry)
+            # incomplete downloads stay behind
+            if entry.endswith('.part') or not os.path.isfile(path):
+                continue
+            try:
+                os.replace(path, os.path.join(pkgcache, entry))
+            except OSError:
+                pass
+        rmtree(private, ignore_errors=True)
+
+
+def sync_snapshot(syncdir):
+    # keeps a sync database snapshot from being dropped while it is in use
+    return file_lock('{0}.lock'.format(syncdir), shared=True)
+
+
+@contextmanager
+def sync_databases(node):
+    # refresh the pacman sync databases once per update run into a fresh
+    # snapshot, that build containers then mount read-only. The snapshot is
+    # kept until the update run is done with it.
+    with ExitStack() as stack:
+        # snapshots are created and dropped one at a time, so none is
+        # dropped before its creator got to use it
+        with file_lock(os.path.join(PACMAN_SYNC_CACHE_DIR, '.lock')):
+            # updates of different repositories may start within the same
+            # second
+            timestamp = '{:%Y%m%d%H%M%S}'.format(datetime.datetime.now())
+            syncdir = mkdtemp(prefix='{0}-'.format(timestamp),
+                              dir=PACMAN_SYNC_CACHE_DIR)
+            stack.enter_context(sync_snapshot(syncdir))
+
+        _refresh_sync_databases(node, syncdir)
+        yield syncdir
+
+
+def _refresh_sync_databases(node, syncdir):
+    volumes = {
+        syncdir:
+            {'bind': '/var/lib/pacman/sync', 'mode': 'rw'},
+    }
+
+    container = node.run(
+        image=DOCKER_IMAGE,
+        command="/bin/sh -c '/sync.sh'",
+        name='{0}_sync_{1}'.format(
+            PROJECT_NAME, os.path.basename(syncdir)),
+        environment={
+            "USER_ID": os.getuid(),
+        },
+        volumes=volumes
+    )
+
+    try:
+        success, reason = follow(
+            container, timeout=DOCKER_HELPER_TIMEOUT,
+            stall_timeout=DOCKER_HELPER_TIMEOUT)
+    finally:
+        node.collect(container, volumes)
+
+    if not success:
+        click.echo(
+            'Error while refreshing the pacman sync databases{0}.'.format(
+                ': {0}'.format(reason) if reason else ''),
+            file=sys.stderr
+        )
+        sys.exit(1)
+
+    # drop snapshots no update run or queued build uses anymore
+    with file_lock(os.path.join(PACMAN_SYNC_CACHE_DIR, '.lock')):
+        for entry in os.listdir(PACMAN_SYNC_CACHE_DIR):
+            snapshot = os.path.join(PACMAN_SYNC_CACHE_DIR, entry)
+            if not entry.split('-')[0].isdigit() \
+                    or not os.path.isdir(snapshot):
+                continue
+
+            lock = '{0}.lock'.format(snapshot)
+            try:
+                with file_lock(lock, blocking=False):
+                    rmtree(snapshot, ignore_errors=True)
+                    os.remove(lock)
+            except LockError:
+                pass
+
+
+# guards the dependency image index between concurrent builds
+_dependency_index_lock = threading.Lock()
+
+
+@contextmanager
+def _dependency_index():
+    # held while reading and writing the index, both between threads and
+    # between processes
+    with _dependency_index_lock, \
+            file_lock('{0}.lock'.format(DOCKER_DEPENDENCY_INDEX)):
+        yield
+
+
+def _load_dependency_index():
+    try:
+        with open(DOCKER_DEPENDENCY_INDEX) as handle:
+            return json.load(handle)
+    except (FileNotFoundError, json.decoder.JSONDecodeError):
+        return {}
+
+
+def _save_dependency_index(index):
+    atomic_json_dump(index, DOCKER_DEPENDENCY_INDEX, indent=2)
+
+
+def _collect_dependency_images(client, images):
+    # drop least recently used dependency images above the limit
+    lru = sorted(images.keys(), key=lambda tag: images[tag]['used'])
+    for tag in lru[:max(0, len(lru) - DOCKER_DEPENDENCY_IMAGE_LIMIT)]:
+        try:
+            client.images.remove(tag)
+        except ImageNotFound:
+            pass
+        except APIError as ex:
+            # still in use by a running build, try again next time
+            click.echo('Unable to remove image {0}: {1}'.format(tag, ex))
+            continue
+        del images[tag]
+
+
+def dependency_image(node, depends, syncdir=None, pkgcache=None):
+    # derive an image from the build image, that already has a set of
+    # dependencies installed, so makepkg does not have to install them again
+    # for every build. Images are keyed by the build image and the
+    # dependency set, so changes to either result in a new image.
+    if not depends:
+        return DOCKER_IMAGE
+
+    client = node.client
+    try:
+        baseimage = client.images.get(DOCKER_IMAGE)
+    except ImageNotFound:
+        return DOCKER_IMAGE
+
+    digest = hashlib.sha256('\n'.join(
+        [baseimage.id] + sorted(depends)).encode()).hexdigest()
+    tag = '{0}:{1}'.format(DOCKER_DEPENDENCY_IMAGE, digest[:32])
+
+    now = int(time.time())
+    with _dependency_index():
+        index = _load_dependency_index()
+        entry = index.get(node.name, {}).get(tag)
+        try:
+            previous = client.images.get(tag)
+        except ImageNotFound:
+            previous = None
+        else:
+            if entry and now - entry['created'] \
+                    < DOCKER_DEPENDENCY_IMAGE_MAX_AGE:
+                entry['used'] = now
+                _save_dependency_index(index)
+                return tag
+
+    click.echo('{0}: preparing dependency image {1}'.format(node.name, tag))
+
+    volumes = {}
+    if syncdir:
+        volumes[syncdir] = {'bind': '/sync', 'mode': 'ro'}
+
+    timestamp = '{:%H-%M-%s}'.format(datetime.datetime.now())
+    with package_cache(pkgcache if node.local else None) as caches:
+        container = node.run(
+            image=DOCKER_IMAGE,
+            command="/bin/sh -c '/deps.sh'",
+            name='{0}_deps_{1}_{2}_{3}'.format(
+                PROJECT_NAME, digest[:12], timestamp, uuid.uuid4().hex[:8]),
+            environment={
+                "DEPENDS": ' '.join(sorted(depends)),
+            },
+            volumes=volumes,
+            caches=caches
+        )
+
+        try:
+            success, _ = follow(
+                container, timeout=DOCKER_HELPER_TIMEOUT,
+                stall_timeout=DOCKER_HELPER_TIMEOUT)
+
+            if not success:
+                # e.g. a dependency that is neither in the official repositories
+                # nor in ours yet, let makepkg sort it out in the build container
+                click.echo(
+                    'Unable to prepare dependency image, falling back to '
+                    '{0}'.format(DOCKER_IMAGE)
+                )
+                return DOCKER_IMAGE
+
+            repository, _, imagetag = tag.partition(':')
+            image = container.commit(repository=repository, tag=imagetag)
+        finally:
+            container.remove()
+
+    # the outdated image lost its tag to the new one
+    if previous and previous.id != image.id:
+        try:
+            client.images.remove(previous.id)
+        except ImageNotFound:
+            pass
+        except APIError as ex:
+            # still in use by a running build
+            click.echo('Unable to remove image {0}: {1}'.format(
+                previous.short_id, ex))
+
+    with _dependency_index():
+        index = _load_dependency_index()
+        images = index.setdefault(node.name, {})
+        images[tag] = {'created': now, 'used': now}
+        _collect_dependency_images(client, images)
+        _save_dependency_index(index)
+
+    return tag
@@ -0,0 +1,434 @@
+import heapq
+import json
+import os
+import random
+import socket
+import socketserver
+import sys
+import threading
+import time
+from contextlib import ExitStack
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+import click
+
+from .constants import CONFIG_DIR, DAEMON_QUEUE_FILE, PROJECT_NAME
+from .container import (
+    update_build_container, sync_databases, sync_snapshot
+)
+from .errors import AurBlobsError, LockError
+from .nodes import NodePool
+from .planner import dependencies, depends_on, order
+from .repository import Repository
+from .utils import atomic_json_dump
+
+# scheduled polls are queued with the lowest priority, so manually enqueued
+# builds always overtake them
+PRIORITY_SCHEDULED = 0
+PRIORITY_MANUAL = 10
+
+
+class WorkQueue:
+    def __init__(self, path):
+        self.path = path
+        self.cond = threading.Condition()
+        self.jobs = []
+        self.seq = 0
+
+        try:
+            with open(self.path) as handle:
+                jobs = json.load(handle)
+        except FileNotFoundError:
+            jobs = []
+        except json.decoder.JSONDecodeError as ex:
+            click.echo(
+                'Queue file is damaged, starting with an empty queue. '
+                '({0})'.format(ex),
+                file=sys.stderr
+            )
+            jobs = []
+
+        for job in jobs:
+            self._push(job)
+
+    def __len__(self):
+        with self.cond:
+            return len(self.jobs)
+
+    def _push(self, job):
+        self.seq += 1
+        job['seq'] = self.seq
+        heapq.heappush(self.jobs, (-job['priority'], job['seq'], job))
+
+    def _save(self):
+        jobs = [job for _, _, job in sorted(self.jobs)]
+        atomic_json_dump(jobs, self.path, indent=2)
+
+    def put(self, repository, package, priority=PRIORITY_SCHEDULED,
+            force=False):
+        with self.cond:
+            # a package is only queued once, merge with the pending job
+            for _, _, job in self.jobs:
+                if job['repository'] == repository \
+                        and job['package'] == package:
+                    if priority > job['priority'] or force:
+                        self.jobs.remove((-job['priority'], job['seq'], job))
+                        heapq.heapify(self.jobs)
+                        job['priority'] = max(priority, job['priority'])
+                        job['force'] = job['force'] or force
+                        self._push(job)
+                        self._save()
+                    return job
+
+            job = {
+                'repository': repository,
+                'package': package,
+                'priority': priority,
+                'force': force,
+                'queued': int(time.time()),
+            }
+            self._push(job)
+            self._save()
+            self.cond.notify_all()
+            return job
+
+    def get(self, take=None):
+        # the first job in order that take accepts, take is passed the
+        # packages queued besides the job
+        with self.cond:
+            while True:
+                entries = sorted(self.jobs)
+                queued = {(job['repository'], job['package'])
+                          for _, _, job in entries}
+                for entry in entries:
+                    job = entry[2]
+                    key = (job['repository'], job['package'])
+                    if take is None or take(job, queued - {key}):
+                        self.jobs.remove(entry)
+                        heapq.heapify(self.jobs)
+                        self._save()
+                        return job
+                self.cond.wait()
+
+    def notify(self):
+        # jobs may have become ready
+        with self.cond:
+            self.cond.notify_all()
+
+    def snapshot(self):
+        with self.cond:
+            return [job for _, _, job in sorted(self.jobs)]
+
+
+class Daemon:
+    def __init__(self, socket_path, interval, jitter, jobs=None, prefetch=0):
+        self.socket_path = socket_path
+        self.interval = interval
+        self.jitter = jitter
+        self.jobs = jobs
+        self.prefetch = max(prefetch, 0)
+
+        self.queue = WorkQueue(DAEMON_QUEUE_FILE)
+        self.pool = NodePool.load()
+        self.repositories = {}
+        self.locks = {}
+        self.lock = threading.Lock()
+        self.running = {}
+        self.building = {}
+        self.next_poll = None
+        self.syncdir = None
+        self.snapshot = ExitStack()
+
+    def load_repositories(self):
+        # keep repositories in memory, but pick up configuration changes
+        # made with the other subcommands in the meantime
+        with self.lock:
+            names = set()
+            for fn in Path(CONFIG_DIR).glob('*.json'):
+                name = os.path.basename(str(fn)).split('.')[:-1][0]
+                mtime = os.stat(str(fn)).st_mtime
+
+                # hold the update lock of every repository we manage
+                if name not in self.locks:
+                    stack = ExitStack()
+                    try:
+                        stack.enter_context(Repository(name).updating())
+                    except LockError:
+                        click.echo(
+                            '{0}: skipped, another update is running'.format(
+                                name),
+                            file=sys.stderr
+                        )
+                        continue
+                    self.locks[name] = stack
+                    self.repositories.pop(name, None)
+
+                names.add(name)
+                loaded = self.repositories.get(name)
+                if loaded and loaded[1] == mtime:
+                    continue
+                self.repositories[name] = (Repository(name), mtime)
+
+            for name in set(self.repositories.keys()) - names:
+                del self.repositories[name]
+                self.locks.pop(name).close()
+
+    def refresh(self):
+        for node in self.pool.nodes:
+            update_build_container(node)
+        snapshot = ExitStack()
+        syncdir = snapshot.enter_context(sync_databases(self.pool.nodes[0]))
+
+        # jobs hold on to the previous snapshot until they are done with it
+        with self.lock:
+            self.syncdir = syncdir
+            self.snapshot, previous = snapshot, self.snapshot
+        previous.close()
+
+    def schedule(self):
+        while True:
+            try:
+                self.load_repositories()
+                self.refresh()
+            except (Exception, SystemExit, AurBlobsError) as ex:
+                click.echo(
+                    'Scheduling run failed: {0}'.format(ex), file=sys.stderr)
+            else:
+                with self.lock:
+                    repositories = [
+                        repository for repository, _
+                        in self.repositories.values()
+                    ]
+                # longest builds first, after their dependencies
+                ordered, _ = order(
+                    pkg for repository in repositories
+                    for pkg in repository.packages)
+                for pkg in ordered:
+                    self.queue.put(pkg.repository.name, pkg.name)
+
+            # spread polls of multiple hosts over time
+            delay = self.interval + random.uniform(0, self.jitter)
+            self.next_poll = int(time.time() + delay)
+            time.sleep(delay)
+
+    def take(self, job, queued):
+        # claim a job for the current worker, unless its package is already
+        # being built, or packages it depends on are queued or being built,
+        # so it gets built against their new version
+        with self.lock:
+            running = {(other['repository'], other['package'])
+                       for other in self.running.values()}
+            if (job['repository'], job['package']) in running:
+                return False
+
+            repository, _ = self.repositories.get(
+                job['repository'], (None, None))
+            if repository:
+                deps = dependencies(repository.packages)
+                for pkg, required in deps.items():
+                    if pkg.name != job['package']:
+                        continue
+                    for dep in required:
+                        key = (repository.name, dep.name)
+                        if key in running:
+                            return False
+                        # within dependency cycles, go in queue order
+                        if key in queued and not depends_on(deps, dep, pkg):
+                            return False
+
+            self.running[threading.current_thread().name] = dict(
+                job, started=int(time.time()))
+            return True
+
+    def work(self, pkgcache):
+        ident = threading.current_thread().name
+        while True:
+            job = self.queue.get(self.take)
+            try:
+                self.build(ident, job, pkgcache)
+            finally:
+                with self.lock:
+                    self.running.pop(ident, None)
+                    self.building.pop(ident, None)
+                self.queue.notify()
+
+    def build(self, ident, job, pkgcache):
+        with self.lock:
+            try:
+                repository, _ = self.repositories[job['repository']]
+            except KeyError:
+                click.echo(
+                    'Dropping job for unknown repository {0}'.format(
+                        job['repository']),
+                    file=sys.stderr
+                )
+                return
+
+        pkg = None
+        for candidate in repository.packages:
+            if candidate.name == job['package']:
+                pkg = candidate
+        if not pkg:
+            click.echo(
+                'Dropping job for unknown package {0}/{1}'.format(
+                    job['repository'], job['package']),
+                file=sys.stderr
+            )
+            return
+
+        with self.lock:
+            self.building[ident] = pkg
+            snapshot = ExitStack()
+            if self.syncdir:
+                snapshot.enter_context(sync_snapshot(self.syncdir))
+            syncdir = self.syncdir
+
+        try:
+            with snapshot:
+                pkg.update(
+                    force=job['force'],
+                    retry_failed=job['force'],
+                    pool=self.pool,
+                    prefetch=self.prefetch > 0,
+                    # pick up where the daemon was stopped
+                    resume=True,
+                    buildopts=dict(
+                        jobs=self.jobs,
+                        pkgcache=pkgcache,
+                        syncdir=syncdir
+                    )
+                )
+            self.save(repository, pkg)
+        except (Exception, SystemExit, AurBlobsError) as ex:
+            # keep the daemon alive, the next poll retries the package
+            click.echo(
+                '{0}: update failed: {1}'.format(pkg.fullname, ex),
+                file=sys.stderr
+            )
+
+    def save(self, repository, pkg):
+        with self.lock:
+            current, _ = self.repositories.get(
+                repository.name, (repository, None))
+
+            # the configuration was reloaded while the package was being
+            # built, carry its new state over instead of saving stale config
+            if current is not repository:
+                for candidate in current.packages:
+                    if candidate.name == pkg.name:
+                        candidate.commit = pkg.commit
+                        candidate.updated = pkg.updated
+                        candidate.pkgs = pkg.pkgs
+                        candidate.depends = pkg.depends
+                        candidate.failures = pkg.failures
+                        candidate.durations = pkg.durations
+                repository = current
+
+            # only the state is written, so the config keeps the mtime it
+            # was loaded with, and changes made by add or remove in the
+            # meantime are still picked up
+            repository.save(config=False)
+
+    def status(self):
+        # packages only get a node once their sources are fetched
+        with self.lock:
+            running = []
+            for ident, job in self.running.items():
+                pkg = self.building.get(ident)
+                running.append(dict(
+                    job, node=pkg.node.name if pkg and pkg.node else None))
+
+        return {
+            'queued': len(self.queue),
+            'queue': self.queue.snapshot(),
+            'running': running,
+            'next_poll': self.next_poll,
+        }
+
+    def handle(self, request):
+        command = request.get('command')
+        if command == 'status':
+            return self.status()
+        elif command == 'enqueue':
+            self.load_repositories()
+            with self.lock:
+                try:
+                    repository, _ = self.repositories[request['repository']]
+                except KeyError:
+                    return {'error': 'Repository with that name does not '
+                                     'exist'}
+
+            names = {pkg.name for pkg in repository.packages}
+            unknown = [name for name in request['packages']
+                       if name not in names]
+            if unknown:
+                return {'error': 'Package {0} not found.'.format(
+                    ', '.join(unknown))}
+
+            jobs = [
+                self.queue.put(
+                    repository.name, name,
+                    priority=request.get('priority', PRIORITY_MANUAL),
+                    force=request.get('force', False)
+                ) for name in request['packages']
+            ]
+            return {'queued': len(self.queue), 'jobs': jobs}
+
+        return {'error': 'Unknown command {0}'.format(command)}
+
+    def serve(self):
+        daemon = self
+
+        class RequestHandler(socketserver.StreamRequestHandler):
+            def handle(self):
+                try:
+                    request = json.loads(self.rfile.readline().decode())
+                    response = daemon.handle(request)
+                except (ValueError, KeyError) as ex:
+                    response = {'error': 'Malformed request: {0}'.format(ex)}
+                self.wfile.write(json.dumps(response).encode() + b'\n')
+
+        class Server(socketserver.ThreadingMixIn,
+                     socketserver.UnixStreamServer):
+            daemon_threads = True
+
+        try:
+            os.unlink(self.socket_path)
+        except FileNotFoundError:
+            pass
+
+        server = Server(self.socket_path, RequestHandler)
+        os.chmod(self.socket_path, 0o600)
+
+        return server
+
+    def run(self):
+        server = self.serve()
+        click.echo('Listening on {0}'.format(self.socket_path))
+
+        with TemporaryDirectory(prefix=PROJECT_NAME, suffix='pkgs') as pkgcache:
+            self.load_repositories()
+
+            threading.Thread(
+                target=self.schedule, name='scheduler', daemon=True).start()
+            # one worker per build slot across all nodes, and some more
+            # fetching sources for upcoming builds
+            for worker in range(self.pool.capacity + self.prefetch):
+                threading.Thread(
+                    target=self.work, args=(pkgcache,),
+                    name='worker-{0}'.format(worker), daemon=True).start()
+
+            try:
+                server.serve_forever()
+            finally:
+                server.server_close()
+                os.unlink(self.socket_path)
+
+
+def request(socket_path, payload):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(socket_path)
+        sock.sendall(json.dumps(payload).encode() + b'\n')
+        with sock.makefile('rb') as handle:
+            return json.loads(handle.readline().decode())
@@ -0,0 +1,291 @@
+import base64
+import hashlib
+import io
+import os
+import re
+import tarfile
+import time
+from contextlib import contextmanager
+
+import zstandard
+
+from .errors import RepositoryError
+from .utils import atomic_symlink
+
+# .PKGINFO keys and the desc sections they end up in, in the order repo-add
+# writes them
+DESC_FIELDS = [
+    ('FILENAME', None),
+    ('NAME', 'pkgname'),
+    ('BASE', 'pkgbase'),
+    ('VERSION', 'pkgver'),
+    ('DESC', 'pkgdesc'),
+    ('GROUPS', 'group'),
+    ('CSIZE', None),
+    ('ISIZE', 'size'),
+    ('MD5SUM', None),
+    ('SHA256SUM', None),
+    ('PGPSIG', None),
+    ('URL', 'url'),
+    ('LICENSE', 'license'),
+    ('ARCH', 'arch'),
+    ('BUILDDATE', 'builddate'),
+    ('PACKAGER', 'packager'),
+    ('REPLACES', 'replaces'),
+    ('CONFLICTS', 'conflict'),
+    ('PROVIDES', 'provides'),
+    ('DEPENDS', 'depend'),
+    ('OPTDEPENDS', 'optdepend'),
+    ('MAKEDEPENDS', 'makedepend'),
+    ('CHECKDEPENDS', 'checkdepend'),
+]
+
+
+def parse_desc(content):
+    # %SECTION% followed by one value per line, terminated by an empty line
+    sections = {}
+    section = None
+    for line in content.splitlines():
+        if line.startswith('%') and line.endswith('%'):
+            section = line.strip('%')
+            sections[section] = []
+        elif line and section:
+            sections[section].append(line)
+        else:
+            section = None
+    return sections
+
+
+def render_desc(sections, order):
+    content = ''
+    for section in order:
+        values = sections.get(section)
+        if not values:
+            continue
+        content += '%{0}%\n{1}\n\n'.format(section, '\n'.join(values))
+    return content
+
+
+@contextmanager
+def open_pkgfile(pkgfile):
+    # tarfile handles gz, bz2 and xz compressed packages on its own, zstd
+    # compressed ones are decompressed while streaming
+    if not pkgfile.endswith('.zst'):
+        with tarfile.open(pkgfile, 'r') as tar:
+            yield tar
+        return
+
+    with open(pkgfile, 'rb') as handle, \
+            zstandard.ZstdDecompressor().stream_reader(handle) as stream, \
+            tarfile.open(fileobj=stream, mode='r|') as tar:
+        yield tar
+
+
+def read_pkgfile(pkgfile):
+    # collect .PKGINFO metadata and the file list of a package in one pass
+    pkginfo = {}
+    files = []
+
+    with open_pkgfile(pkgfile) as tar:
+        for member in tar:
+            if member.name == '.PKGINFO':
+                handle = tar.extractfile(member)
+                for line in handle.read().decode().splitlines():
+                    try:
+                        k, v = line.split('=', 1)
+                        k = k.strip()
+                        v = v.strip()
+                    except ValueError:
+                        continue
+                    if k.startswith('#'):
+                        continue
+                    pkginfo.setdefault(k, []).append(v)
+            elif not member.name.startswith('.'):
+                files.append(
+                    member.name + '/' if member.isdir() else member.name)
+
+    if 'pkgname' not in pkginfo:
+        raise RepositoryError(
+            '{0}: not a valid package, .PKGINFO missing'.format(pkgfile))
+
+    return pkginfo, sorted(files)
+
+
+class RepositoryDatabase:
+    # pure python implementation of the pacman sync database format, that
+    # keeps an index of the repository in memory and writes the db and files
+    # archives in one pass
+    def __init__(self, basedir, name):
+        self.basedir = basedir
+        self.name = name
+
+        # pkgname -> {'desc': sections, 'files': [paths]}
+        self.entries = {}
+
+    def db_file(self):
+        return os.path.join(self.basedir, '{0}.db.tar.gz'.format(self.name))
+
+    def files_file(self):
+        return os.path.join(
+            self.basedir, '{0}.files.tar.gz'.format(self.name))
+
+    def load(self):
+        # the files database is a superset of the regular database
+        for path, with_files in [(self.files_file(), True),
+                                 (self.db_file(), False)]:
+            if os.path.exists(path):
+                break
+        else:
+            return self
+
+        entries = {}
+        with tarfile.open(path, 'r:gz') as tar:
+            for member in tar:
+                if not member.isfile():
+                    continue
+                dirname, _, filename = member.name.rpartition('/')
+                entry = entries.setdefault(dirname, {'desc': {}, 'files': []})
+                content = tar.extractfile(member).read().decode()
+                if filename == 'desc':
+                    entry['desc'] = parse_desc(content)
+                elif filename == 'files' and with_files:
+                    entry['files'] = parse_desc(content).get('FILES', [])
+
+        for entry in entries.values():
+            try:
+                self.entries[entry['desc']['NAME'][0]] = entry
+            except (KeyError, IndexError):
+                continue
+
+        return self
+
+    def add(self, pkgfile, filename=None):
+        # add a package that was already copied and signed into the
+        # repository, possibly under a temporary name, that is replaced by
+        # filename. Returns the filename of the package it replaces.
+        pkginfo, files = read_pkgfile(pkgfile)
+
+        md5 = hashlib.md5()
+        sha256 = hashlib.sha256()
+        with open(pkgfile, 'rb') as handle:
+            for chunk in iter(lambda: handle.read(65536), b''):
+                md5.update(chunk)
+                sha256.update(chunk)
+
+        desc = {}
+        for section, key in DESC_FIELDS:
+            if key:
+                desc[section] = pkginfo.get(key, [])
+        desc['FILENAME'] = [filename or os.path.basename(pkgfile)]
+        desc['CSIZE'] = [str(os.path.getsize(pkgfile))]
+        desc['MD5SUM'] = [md5.hexdigest()]
+        desc['SHA256SUM'] = [sha256.hexdigest()]
+
+        try:
+            with open(pkgfile + '.sig', 'rb') as handle:
+                desc['PGPSIG'] = [base64.b64encode(handle.read()).decode()]
+        except FileNotFoundError:
+            pass
+
+        pkgname = desc['NAME'][0]
+        replaced = self.filename(pkgname)
+
+        self.entries[pkgname] = {'desc': desc, 'files': files}
+
+        if replaced == desc['FILENAME'][0]:
+            return None
+        return replaced
+
+    def remove(self, pkgname):
+        # returns the filename of the removed package
+        filename = self.filename(pkgname)
+        self.entries.pop(pkgname, None)
+        return filename
+
+    def filename(self, pkgname):
+        try:
+            return self.entries[pkgname]['desc']['FILENAME'][0]
+        except (KeyError, IndexError):
+            return None
+
+    def write(self, sign=None, staged=None):
+        order = [section for section, _ in DESC_FIELDS]
+        mtime = int(time.time())
+
+        def add_member(tar, name, content=None):
+            info = tarfile.TarInfo(name)
+            info.mtime = mtime
+            if content is None:
+                info.type = tarfile.DIRTYPE
+                info.mode = 0o755
+                tar.addfile(info)
+            else:
+                data = content.encode()
+                info.mode = 0o644
+                info.size = len(data)
+                tar.addfile(info, io.BytesIO(data))
+
+        # every write creates a new generation of the db and files
+        # archives, that is published by switching the symlinks pacman and
+        # mirrors fetch over once everything has been written and signed
+        generation = '{0:d}'.format(int(time.time() * 1000000))
+        targets = [self.db_file(), self.files_file()]
+        generations = [
+            '{0}.{1}.tar.gz'.format(path[:-len('.tar.gz')], generation)
+            for path in targets
+        ]
+
+        with tarfile.open(generations[0], 'w:gz') as db, \
+                tarfile.open(generations[1], 'w:gz') as files:
+            for pkgname in sorted(self.entries.keys()):
+                entry = self.entries[pkgname]
+                dirname = '{0}-{1}'.format(
+                    pkgname, entry['desc']['VERSION'][0])
+                desc = render_desc(entry['desc'], order)
+
+                for tar in (db, files):
+                    add_member(tar, dirname)
+                    add_member(tar, '{0}/desc'.format(dirname), desc)
+                add_member(files, '{0}/files'.format(dirname), render_desc(
+                    {'FILES': entry['files']}, ['FILES']))
+
+        if sign:
+            for path in generations:
+                sign(path)
+
+        # packages are moved into place right before the new generation is
+        # published, so readers of the current one keep getting the files it
+        # describes, even when a rebuild reuses a filename
+        for source, path in (staged or {}).items():
+            os.replace(source, path)
+
+        for path, target in zip(targets, generations):
+            # pacman fetches $repo.db and $repo.files, the archive and its
+            # signature are switched right after each other
+            for link in (path, path[:-len('.tar.gz')]):
+                atomic_symlink(os.path.basename(target), link)
+            for link in (path, path[:-len('.tar.gz')]):
+                if sign:
+                    atomic_symlink(
+                        os.path.basename(target) + '.sig', link + '.sig')
+                elif os.path.lexists(link + '.sig'):
+                    os.remove(link + '.sig')
+
+        self.collect(generation)
+
+    def collect(self, generation):
+        # keep the previous generation for readers still downloading it
+        pattern = re.compile(r'^{0}\.(db|files)\.(\d+)\.tar\.gz(\.sig)?$'.format(
+            re.escape(self.name)))
+
+        generations = set()
+        for filename in os.listdir(self.basedir):
+            match = pattern.match(filename)
+            if match:
+                generations.add(match.group(2))
+
+        outdated = sorted(generations - {generation}, key=int)[:-1]
+        for filename in os.listdir(self.basedir):
+            match = pattern.match(filename)
+            if match and match.group(2) in outdated:
+                os.remove(os.path.join(self.basedir, filename))
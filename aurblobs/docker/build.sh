@@ -15,16 +15,62 @@ SigLevel = Never
 Server = file:///repo
 EOF
 
-sudo pacman -Sy
+# downloads go to the cache of this container, the shared one is only read
+if [ -d /var/cache/pacman/shared ] \
+        && ! grep -q '^CacheDir = /var/cache/pacman/shared/' /etc/pacman.conf; then
+    sudo sed -i \
+        -e '/^\[options\]/a CacheDir = /var/cache/pacman/pkg/' \
+        -e '/^\[options\]/a CacheDir = /var/cache/pacman/shared/' \
+        /etc/pacman.conf
+fi
+
+if [ -d /sync ]; then
+    # start from the snapshot taken at the beginning of the update run and
+    # only pick up the current state of our own repository
+    sudo cp -r /sync/. /var/lib/pacman/sync/
+    sudo cp /repo/${REPO_NAME}.db /var/lib/pacman/sync/${REPO_NAME}.db
+else
+    sudo pacman -Sy
+fi
+
+# package compression, threads default to the number of cores
+LEVEL=${COMPRESS_LEVEL:+-$COMPRESS_LEVEL}
+THREADS=-T${COMPRESS_THREADS:-0}
+
+cat << EOF > ~/.makepkg.conf
+COMPRESSZST=(/compress.sh zstd -c -z -q ${THREADS} ${LEVEL} -)
+COMPRESSXZ=(/compress.sh xz -c -z ${THREADS} ${LEVEL} -)
+COMPRESSGZ=(/compress.sh gzip -c -f -n ${LEVEL})
+EOF
+
+if [ ! -z $PKGEXT ]; then
+    echo "PKGEXT='${PKGEXT}'" >> ~/.makepkg.conf
+fi
 
 cd /pkg
+rm -f .compression
+
+# start from the shared keyring, only keys missing from it are received
+if [ -d /keyring ]; then
+    mkdir -p -m 700 ~/.gnupg
+    cp /keyring/pubring.* /keyring/trustdb.gpg ~/.gnupg/ 2>/dev/null || true
+fi
 
-# import gpg keys if necessary
 (source PKGBUILD;
- if [ ! -z $validpgpkeys ]; then
-        gpg --recv-keys $validpgpkeys
- fi)
+ for key in "${validpgpkeys[@]}"; do
+        gpg --list-keys "$key" > /dev/null 2>&1 \
+            || gpg ${KEYSERVER:+--keyserver $KEYSERVER} --recv-keys "$key"
+ done)
 
 makepkg -fs --noconfirm MAKEFLAGS=-j$JOBS
 
+# remote nodes only ship the results back
+if [ -n "$ARTIFACTS" ]; then
+    mkdir -p "$ARTIFACTS"
+    mv *.pkg.tar* "$ARTIFACTS"/
+    if [ -f .compression ]; then
+        mv .compression "$ARTIFACTS"/
+    fi
+fi
+
 exit 0
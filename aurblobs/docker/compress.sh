@@ -0,0 +1,9 @@
+#!/bin/bash
+
+# run the compressor configured for makepkg and record how long it took
+START=$(date +%s.%N)
+"$@"
+STATUS=$?
+echo "${START} $(date +%s.%N)" >> /pkg/.compression
+
+exit $STATUS
@@ -0,0 +1,22 @@
+#!/bin/bash
+
+set -e
+
+# downloads go to the cache of this container, the shared one is only read
+if [ -d /var/cache/pacman/shared ] \
+        && ! grep -q '^CacheDir = /var/cache/pacman/shared/' /etc/pacman.conf; then
+    sed -i \
+        -e '/^\[options\]/a CacheDir = /var/cache/pacman/pkg/' \
+        -e '/^\[options\]/a CacheDir = /var/cache/pacman/shared/' \
+        /etc/pacman.conf
+fi
+
+if [ -d /sync ]; then
+    cp -r /sync/. /var/lib/pacman/sync/
+else
+    pacman -Sy
+fi
+
+pacman -S --noconfirm --needed --asdeps $DEPENDS
+
+exit 0
@@ -0,0 +1,11 @@
+#!/bin/bash
+
+set -e
+
+cd /pkg
+
+# download and checksum all sources ahead of the build, signatures are
+# verified by the build container that has the keys imported
+makepkg --verifysource --skippgpcheck --noconfirm
+
+exit 0
@@ -0,0 +1,10 @@
+#!/bin/bash
+
+set -e
+
+pacman -Sy
+
+# hand the snapshot over to the invoking user, so it can be pruned later on
+chown -R $USER_ID /var/lib/pacman/sync
+
+exit 0
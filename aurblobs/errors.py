@@ -14,3 +14,7 @@ class PackageDoesNotExist(PackageError):
 
 class RepositoryError(AurBlobsError):
     pass
+
+
+class LockError(AurBlobsError):
+    pass
@@ -0,0 +1,108 @@
+import json
+import os
+import sys
+import threading
+import time
+from shutil import rmtree
+
+import click
+
+from .constants import BUILD_CACHE_DIR, CACHE_DIR
+from .utils import atomic_json_dump
+
+# stages a package passes through during an update run, in order
+STAGE_FETCHED = 'fetched'
+STAGE_BUILT = 'built'
+STAGE_SIGNED = 'signed'
+STAGE_ADDED = 'added'
+
+
+class Journal:
+    # records the last completed stage of every package of an update run,
+    # so an interrupted run can continue where it stopped. The journal is
+    # read from disk on every access, so any number of instances of the
+    # same repository can be used from different threads.
+    lock = threading.Lock()
+
+    def __init__(self, name):
+        self.name = name
+
+    def journal_file(self):
+        return os.path.join(CACHE_DIR, '{0}.journal.json'.format(self.name))
+
+    def workdir(self, pkgname):
+        return os.path.join(BUILD_CACHE_DIR, self.name, pkgname)
+
+    def _load(self):
+        try:
+            with open(self.journal_file()) as handle:
+                return json.load(handle)
+        except FileNotFoundError:
+            return {}
+        except json.decoder.JSONDecodeError as ex:
+            click.echo(
+                '{0}: journal is damaged, starting over. ({1})'.format(
+                    self.name, ex),
+                file=sys.stderr
+            )
+            return {}
+
+    def _save(self, entries):
+        if entries:
+            atomic_json_dump(entries, self.journal_file(), indent=2)
+        else:
+            try:
+                os.remove(self.journal_file())
+            except FileNotFoundError:
+                pass
+
+    def get(self, pkgname):
+        with self.lock:
+            entry = self._load().get(pkgname)
+
+        # the build directory went away, e.g. with a cleared cache
+        if entry and not os.path.isdir(self.workdir(pkgname)):
+            return None
+        return entry
+
+    def record(self, pkgname, stage, **data):
+        with self.lock:
+            entries = self._load()
+            entry = entries.setdefault(pkgname, {})
+            entry.update(data, stage=stage, recorded=int(time.time()))
+            self._save(entries)
+            return entry
+
+    def discard(self, pkgname):
+        # forget the package and remove its build directory
+        with self.lock:
+            entries = self._load()
+            if entries.pop(pkgname, None) is not None:
+                self._save(entries)
+        rmtree(self.workdir(pkgname), ignore_errors=True)
+
+    def added(self):
+        with self.lock:
+            return [pkgname for pkgname, entry in self._load().items()
+                    if entry['stage'] == STAGE_ADDED]
+
+    def collect(self, pkgnames):
+        # packages are complete once they were added and the state recording
+        # that was written
+        with self.lock:
+            entries = self._load()
+            added = [pkgname for pkgname in pkgnames
+                     if entries.get(pkgname, {}).get('stage') == STAGE_ADDED]
+            if not added:
+                return
+            for pkgname in added:
+                del entries[pkgname]
+            self._save(entries)
+
+        for pkgname in added:
+            rmtree(self.workdir(pkgname), ignore_errors=True)
+
+    def clear(self):
+        with self.lock:
+            self._save({})
+        rmtree(os.path.join(BUILD_CACHE_DIR, self.name), ignore_errors=True)
@@ -0,0 +1,89 @@
+import json
+import os
+import sys
+import threading
+import time
+
+import click
+from pretty_bad_protocol import gnupg
+
+from .constants import (
+    PGP_KEYRING_DIR, PGP_KEYRING_INDEX, PGP_KEY_TTL, PGP_KEYSERVER
+)
+from .utils import atomic_json_dump
+
+
+class SourceKeyring:
+    # persistent keyring with the keys PKGBUILDs list in validpgpkeys, that
+    # is mounted into build containers. Keys are received once and
+    # refreshed in the background once they are older than PGP_KEY_TTL, so
+    # builds don't wait for the keyserver.
+    def __init__(self, homedir=PGP_KEYRING_DIR, index=PGP_KEYRING_INDEX):
+        self.homedir = homedir
+        self.index = index
+        self.lock = threading.Lock()
+        self.refreshing = set()
+
+    def _load(self):
+        try:
+            with open(self.index) as handle:
+                return json.load(handle)
+        except (FileNotFoundError, json.decoder.JSONDecodeError):
+            return {}
+
+    def _receive(self, keys):
+        os.makedirs(self.homedir, mode=0o700, exist_ok=True)
+        gpg = gnupg.GPG(homedir=self.homedir)
+        result = gpg.recv_keys(*keys, keyserver=PGP_KEYSERVER)
+
+        # validpgpkeys may list fingerprints of subkeys or long key ids
+        received = [
+            key for key in keys
+            if any(fingerprint.upper().endswith(key)
+                   for fingerprint in result.fingerprints)
+        ]
+
+        with self.lock:
+            index = self._load()
+            now = int(time.time())
+            for key in received:
+                index[key] = now
+            atomic_json_dump(index, self.index, indent=2)
+            self.refreshing.difference_update(keys)
+
+        failed = set(keys) - set(received)
+        if failed:
+            click.echo(
+                'Unable to receive PGP keys {0} from {1}'.format(
+                    ', '.join(sorted(failed)), PGP_KEYSERVER),
+                file=sys.stderr
+            )
+
+    def ensure(self, keys):
+        # receive missing keys right away, refresh outdated ones in the
+        # background
+        keys = {key.replace(' ', '').upper() for key in keys}
+        if not keys:
+            return
+
+        with self.lock:
+            index = self._load()
+            now = int(time.time())
+            missing = sorted(key for key in keys if key not in index)
+            outdated = sorted(
+                key for key in keys
+                if key in index and now - index[key] > PGP_KEY_TTL
+                and key not in self.refreshing
+            )
+            self.refreshing.update(outdated)
+
+        if outdated:
+            threading.Thread(
+                target=self._receive, args=(outdated,),
+                name='keyring-refresh', daemon=True).start()
+
+        if missing:
+            self._receive(missing)
+
+
+keyring = SourceKeyring()
@@ -0,0 +1,210 @@
+import json
+import os
+import sys
+import tarfile
+import threading
+from contextlib import contextmanager
+from tempfile import TemporaryFile
+
+import click
+import docker
+import requests
+from docker.errors import APIError, NotFound
+
+from .constants import NODES_FILE
+
+
+class BuildNode:
+    def __init__(self, name, url=None, capacity=1, tls=False, local=None):
+        self.name = name
+        self.url = url
+        self.capacity = capacity
+        self.tls = tls
+
+        # nodes sharing our filesystem get bind mounts, all others have
+        # files shipped into and out of their containers
+        if local is None:
+            local = not url or url.startswith('unix://')
+        self.local = local
+
+        self.active = 0
+        self._client = None
+
+    @property
+    def client(self):
+        if not self._client:
+            if self.url:
+                self._client = docker.DockerClient(
+                    base_url=self.url, tls=self.tls)
+            else:
+                self._client = docker.from_env()
+        return self._client
+
+    @staticmethod
+    def pack(path, arcname, include=None):
+        # archive path into a temporary file, that is streamed to the docker
+        # daemon. With include, only the listed files below path are shipped,
+        # with symlinks resolved.
+        handle = TemporaryFile()
+        with tarfile.open(fileobj=handle, mode='w') as tar:
+            if include is None:
+                tar.add(path, arcname=arcname)
+            else:
+                tar.add(path, arcname=arcname, recursive=False)
+                for name in include:
+                    source = os.path.join(path, name)
+                    if os.path.exists(source):
+                        tar.add(os.path.realpath(source),
+                                arcname=os.path.join(arcname, name))
+        handle.seek(0)
+        return handle
+
+    @staticmethod
+    def unpack(container, source, path, include=None):
+        # copy the contents of a directory in the container back to path
+        try:
+            stream, _ = container.get_archive(source)
+        except NotFound:
+            # e.g. a failed build didn't produce any results
+            return
+
+        with TemporaryFile() as handle:
+            for chunk in stream:
+                handle.write(chunk)
+            handle.seek(0)
+
+            with tarfile.open(fileobj=handle, mode='r') as tar:
+                for member in tar:
+                    parts = member.name.split('/')[1:]
+                    if not parts or '..' in parts \
+                            or not (member.isfile() or member.isdir()):
+                        continue
+                    member.name = os.path.join(*parts)
+                    if include and not include(member.name):
+                        continue
+                    tar.extract(member, path)
+
+    def run(self, image, name, volumes, caches=None, **kwargs):
+        # start a detached container, caches are only mounted on local nodes.
+        # Besides bind and mode, volumes may list the files to ship to
+        # remote nodes in include, and the directory to ship back from them
+        # in collect.
+        try:
+            if self.local:
+                binds = {
+                    path: {'bind': bind['bind'], 'mode': bind['mode']}
+                    for path, bind in volumes.items()
+                }
+                binds.update(caches or {})
+                return self.client.containers.run(
+                    image=image,
+                    name=name,
+                    detach=True,
+                    volumes=binds,
+                    **kwargs
+                )
+
+            container = self.client.containers.create(
+                image=image,
+                name=name,
+                **kwargs
+            )
+            try:
+                for path, bind in volumes.items():
+                    with self.pack(path, bind['bind'].lstrip('/'),
+                                   bind.get('include')) as archive:
+                        container.put_archive('/', archive)
+                container.start()
+            except BaseException:
+                # don't leave the container behind on the node
+                try:
+                    container.remove(force=True)
+                except (APIError, requests.exceptions.ConnectionError):
+                    pass
+                raise
+            return container
+        except requests.exceptions.ConnectionError as ex:
+            click.echo(
+                'Unable to start container on {0}, is the docker daemon '
+                'running?\n{1}'.format(self.name, ex),
+                file=sys.stderr
+            )
+            sys.exit(1)
+        except APIError as ex:
+            click.echo(
+                'Unable to start container on {0}: {1}'.format(self.name, ex),
+                file=sys.stderr
+            )
+            sys.exit(1)
+
+    def collect(self, container, volumes, include=None):
+        # ship results in writable volumes back from remote nodes
+        try:
+            if not self.local:
+                for path, bind in volumes.items():
+                    if bind['mode'] == 'rw':
+                        self.unpack(container, bind.get('collect', bind['bind']),
+                                    path, include)
+        finally:
+            container.remove()
+
+
+class NodePool:
+    def __init__(self, nodes):
+        self.nodes = nodes
+        self.cond = threading.Condition()
+
+    @classmethod
+    def load(cls):
+        try:
+            with open(NODES_FILE) as handle:
+                config = json.load(handle)
+        except FileNotFoundError:
+            return cls([BuildNode('local')])
+        except json.decoder.JSONDecodeError as ex:
+            click.echo(
+                'Build node configuration is damaged, exiting. ({0})'.format(
+                    ex),
+                file=sys.stderr
+            )
+            sys.exit(1)
+
+        return cls([
+            BuildNode(
+                name=node.get('name', node.get('url', 'local')),
+                url=node.get('url'),
+                capacity=node.get('capacity', 1),
+                tls=node.get('tls', False),
+                local=node.get('local'),
+            ) for node in config['nodes']
+        ])
+
+    @property
+    def capacity(self):
+        return sum(node.capacity for node in self.nodes)
+
+    def acquire(self):
+        with self.cond:
+            while True:
+                available = [node for node in self.nodes
+                             if node.active < node.capacity]
+                if available:
+                    # least loaded node first
+                    node = min(available,
+                               key=lambda n: n.active / n.capacity)
+                    node.active += 1
+                    return node
+                self.cond.wait()
+
+    def release(self, node):
+        with self.cond:
+            node.active -= 1
+            self.cond.notify()
+
+    @contextmanager
+    def node(self):
+        node = self.acquire()
+        try:
+            yield node
+        finally:
+            self.release(node)
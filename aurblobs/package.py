@@ -1,21 +1,41 @@
 import datetime
+import hashlib
 import os
+import re
 import sys
-import tarfile
 import time
+from collections import deque
+from contextlib import ExitStack
+from fnmatch import fnmatch
 from pathlib import Path
-from tempfile import TemporaryDirectory
 
 import click
-import docker
 import git
 import requests
 
-from .constants import PROJECT_NAME, DOCKER_IMAGE, PACMAN_SYNC_CACHE_DIR
+from .constants import (
+    DOCKER_IMAGE, PGP_KEYRING_DIR, PGP_KEYSERVER, PROJECT_NAME
+)
+from .container import (
+    build_image_id, dependency_image, follow, package_cache
+)
+from .database import open_pkgfile
+from .journal import STAGE_ADDED, STAGE_BUILT, STAGE_FETCHED, STAGE_SIGNED
+from .keyring import keyring
+from .nodes import BuildNode
+from .planner import dependencies, required
+from .trace import tracer
 
 
 class Package:
-    def __init__(self, repository, name, commit=None, updated=None, pkgs=None):
+    # number of build log lines kept with a failure record
+    failure_log_lines = 30
+
+    # number of recent build durations kept for planning
+    duration_history = 5
+
+    def __init__(self, repository, name, commit=None, updated=None, pkgs=None,
+                 depends=None, failures=None, durations=None, options=None):
         # back-reference to the repository this package is being served in
         self.repository = repository
 
@@ -29,6 +49,33 @@ class Package:
             pkgs = {}
         self.pkgs = pkgs
 
+        # package specific settings, that override the repository settings
+        if not options:
+            options = {}
+        self.options = options
+
+        # names of the packages required to build this package, as of the
+        # last build attempt
+        if not depends:
+            depends = []
+        self.depends = depends
+
+        # record of consecutive build failures, so broken packages are not
+        # retried on every update
+        self.failures = failures
+
+        # seconds taken by the most recent successful builds
+        if not durations:
+            durations = []
+        self.durations = durations
+
+        # tail of the log of the most recent build and why it was killed
+        self.build_log = []
+        self.build_error = None
+
+        # build node the package is currently being built on
+        self.node = None
+
     def __hash__(self):
         # deduplicate packages by name
         return hash(self.name)
@@ -37,6 +84,29 @@ class Package:
     def fullname(self):
         return '{0}/{1}'.format(self.repository.name, self.name)
 
+    @property
+    def compression(self):
+        # pkgext, level and threads passed to makepkg
+        compression = dict(self.repository.compression)
+        compression.update(self.options.get('compression', {}))
+        return compression
+
+    @property
+    def timeouts(self):
+        # seconds a build may take in total and without any output
+        timeouts = {
+            'build': self.repository.build_timeout,
+            'stall': self.repository.stall_timeout,
+        }
+        timeouts.update(self.repository.timeouts)
+        timeouts.update(self.options.get('timeouts', {}))
+        return timeouts
+
+    @property
+    def pkg_pattern(self):
+        # glob matching the packages resulting from a build
+        return '*{0}'.format(self.compression.get('pkgext', '.pkg.tar*'))
+
     def aur_pkg_url(self):
         return 'https://aur.archlinux.org/packages/{0}/'.format(self.name)
 
@@ -51,6 +121,11 @@ class Package:
             '-cvs', '-svn', '-git', '-hg', '-bzr', '-darcs'
         ))
 
+    def remote_head(self):
+        with tracer.span('ls-remote', package=self.fullname):
+            return git.cmd.Git().ls_remote(
+                self.aur_git_url(), "HEAD").split()[0]
+
     def needs_rebuild(self, head, force=False):
         if force:
             return True
@@ -77,175 +152,539 @@ class Package:
         click.echo('{0} is up-to-date'.format(self.fullname))
         return False
 
-    def update(self, buildopts=None, force=False):
+    def backoff(self, head, image):
+        # returns the remaining seconds until a failed package may be retried
+        if not self.failures:
+            return 0
+
+        # the PKGBUILD or the build environment changed, retry immediately
+        if self.failures['commit'] != head or self.failures['image'] != image:
+            return 0
+
+        delay = min(
+            self.repository.failure_backoff * 2 ** (
+                self.failures['count'] - 1),
+            self.repository.failure_backoff_max
+        )
+        return max(0, self.failures['last'] + delay - int(time.time()))
+
+    def update(self, buildopts=None, force=False, retry_failed=False,
+               pool=None, prefetch=False, resume=False):
         if not buildopts:
             buildopts = {}
 
-        head = git.cmd.Git().ls_remote(self.aur_git_url(), "HEAD").split()[0]
-        if not self.needs_rebuild(head, force):
-            return False
+        # with a pool, a build node is only taken once the sources are there
+        if pool:
+            primary = pool.nodes[0]
+        else:
+            primary = buildopts.get('node') or BuildNode('local')
+
+        journal = self.repository.journal
+        entry = journal.get(self.name) if resume else None
+        image = None
+
+        if entry:
+            click.echo('{0}: resuming, {1} in a previous run'.format(
+                self.fullname, entry['stage']))
+        else:
+            # leftovers of an interrupted run are not picked up
+            journal.discard(self.name)
+
+            if not retry_failed:
+                failed = self.repository.failed_dependencies(self)
+                if failed:
+                    click.echo(
+                        '{0}: skipped, dependencies failed to build: '
+                        '{1}'.format(self.fullname, ', '.join(sorted(failed))),
+                        file=sys.stderr
+                    )
+                    return False
+
+            head = self.remote_head()
+            if not self.needs_rebuild(head, force):
+                # a failed forced rebuild is settled by the published build
+                if self.failures and self.failures['commit'] == self.commit:
+                    self.failures = None
+                return False
+
+            image = build_image_id(primary)
+            if not retry_failed:
+                remaining = self.backoff(head, image)
+                if remaining:
+                    click.echo(
+                        '{0}: skipped, failed to build {1} times, next retry '
+                        'in {2}s'.format(
+                            self.fullname, self.failures['count'], remaining),
+                        file=sys.stderr
+                    )
+                    return False
 
-        with TemporaryDirectory(prefix=PROJECT_NAME, suffix=self.name) as basedir:
-            pkgroot = os.path.join(basedir, '{0}.git'.format(self.name))
-            pkgrepo = git.Repo.clone_from(
-                self.aur_git_url(), pkgroot
-            )
+        # the build directory outlives the run until the package is published
+        pkgroot = os.path.join(
+            journal.workdir(self.name), '{0}.git'.format(self.name))
+
+        if not entry:
+            with tracer.span('clone', package=self.fullname):
+                pkgrepo = git.Repo.clone_from(
+                    self.aur_git_url(), pkgroot
+                )
 
             head = str(pkgrepo.head.commit)
+            self.depends = sorted({
+                re.split('[<>=]', dep)[0]
+                for dep in self.get_srcinfo_depends(pkgroot)
+            })
+
+            if prefetch:
+                self.fetch(pkgroot, primary)
+
+            entry = journal.record(
+                self.name, STAGE_FETCHED, commit=head, depends=self.depends)
+        else:
+            self.depends = entry['depends']
+
+        if entry['stage'] == STAGE_FETCHED:
+            # keys to verify the sources with are received into the shared
+            # keyring before taking a build slot, so waiting for the
+            # keyserver overlaps with other builds
+            validpgpkeys = self.get_srcinfo_values(
+                pkgroot, ('validpgpkeys',))
+            if validpgpkeys:
+                with tracer.span('keyring', package=self.fullname):
+                    keyring.ensure(validpgpkeys)
+
             buildopts['pkgroot'] = pkgroot
-            if self.build(**buildopts):
+            with ExitStack() as stack:
+                if pool:
+                    buildopts['node'] = stack.enter_context(pool.node())
+                self.node = buildopts.get('node')
+                started = time.monotonic()
+                try:
+                    success = self.build(**buildopts)
+                finally:
+                    self.node = None
+                duration = int(time.monotonic() - started)
+
+            if not success:
+                count = self.failures['count'] + 1 if self.failures else 1
+                self.failures = {
+                    'count': count,
+                    'commit': entry['commit'],
+                    'image': image or build_image_id(primary),
+                    'last': int(time.time()),
+                    'reason': self.build_error,
+                    'error': self.build_log,
+                }
+                if self.build_error:
+                    click.echo(
+                        '{0}: build {1}.'.format(
+                            self.fullname, self.build_error),
+                        file=sys.stderr
+                    )
+                else:
+                    click.echo(
+                        '{0}: build unsuccessful check the build log for '
+                        'errors.'.format(self.fullname),
+                        file=sys.stderr
+                    )
+                journal.discard(self.name)
+                return False
+
+            click.echo(
+                '{0}: package build complete'.format(self.fullname)
+            )
+
+            resulting_pkgs = self.get_pkg_names(pkgroot, self.pkg_pattern)
+
+            isize = sum(pkg['isize'] for pkg in resulting_pkgs.values())
+            csize = sum(pkg['csize'] for pkg in resulting_pkgs.values())
+            compression_time = self.get_compression_time(pkgroot)
+            if csize and compression_time is not None:
                 click.echo(
-                    '{0}: package build complete'.format(self.fullname)
+                    '{0}: compressed {1} packages in {2:.1f}s, '
+                    'ratio {3:.2f}'.format(
+                        self.fullname, len(resulting_pkgs), compression_time,
+                        isize / csize)
                 )
 
-                self.repository.sign_and_add(pkgroot)
+            entry = journal.record(
+                self.name, STAGE_BUILT, pkgs=resulting_pkgs, duration=duration)
+
+        return self.publish(pkgroot, entry)
+
+    def publish(self, pkgroot, entry):
+        journal = self.repository.journal
+        resulting_pkgs = entry['pkgs']
+
+        if entry['stage'] == STAGE_BUILT:
+            # identical rebuilds, e.g. of vcs packages without new commits,
+            # are not published again, so mirrors and clients don't download
+            # the same package twice
+            changed = [
+                pkginfo['file'] for pkgname, pkginfo in resulting_pkgs.items()
+                if not self.is_unchanged(pkgname, pkginfo)
+            ]
+
+            filenames = []
+            if changed:
+                filenames = self.repository.sign_packages([
+                    os.path.join(pkgroot, filename) for filename in changed
+                ])
+                if filenames is None:
+                    return False
+
+            entry = journal.record(self.name, STAGE_SIGNED, files=filenames)
+
+        if entry['stage'] == STAGE_SIGNED:
+            if entry['files']:
+                if not self.repository.add_packages(entry['files']):
+                    return False
                 click.echo(
                     '{0}: package signed and repository updated'.format(
                         self.fullname
                     )
                 )
-
-                resulting_pkgs = self.get_pkg_names(pkgroot)
-
-                # show new packages, that did not exist before
-                new = [pkgname for pkgname in resulting_pkgs.keys()
-                       if pkgname not in self.pkgs]
-                if new:
-                    click.echo('  new:')
-                    for pkgname in new:
-                        click.echo('    - {0} ({1})'.format(
-                            pkgname, resulting_pkgs[pkgname]['version']
-                        ))
-
-                # show upgraded packages, where the version string changed
-                upgraded = [
-                    pkgname for pkgname, pkginfo in resulting_pkgs.items()
-                    if pkgname in self.pkgs
-                    and self.pkgs[pkgname]['version'] != pkginfo['version']
-                ]
-                if upgraded:
-                    click.echo('  upgraded:')
-                    for pkgname in upgraded:
-                        click.echo('    - {0} ({1} → {2})'.format(
-                            pkgname,
-                            self.pkgs[pkgname]['version'],
-                            resulting_pkgs[pkgname]['version'],
-                        ))
-
-                # show old packages that were not rebuilt
-                # TODO: remove these packages from the repository
-                dangling = [
-                    pkgname for pkgname in self.pkgs.keys()
-                    if pkgname not in resulting_pkgs
-                ]
-                if dangling:
-                    click.echo('  dangling:')
-                    for pkgname in dangling:
-                        click.echo(
-                            '    - {0} ({1}): {2}'.format(
-                                pkgname,
-                                self.pkgs[pkgname]['version'],
-                                self.pkgs[pkgname]['file']
-                            )
-                        )
-
-                self.commit = head
-                self.updated = int(time.time())
-                self.pkgs = resulting_pkgs
             else:
                 click.echo(
-                    '{0}: build unsuccessful check the build log for '
-                    'errors.'.format(self.fullname),
-                    file=sys.stderr
+                    '{0}: rebuild is identical to the published packages, '
+                    'nothing to publish'.format(self.fullname)
                 )
 
-        return False
+        # packages that were not published again stay as they are
+        resulting_pkgs = {
+            pkgname: pkginfo if pkginfo['file'] in entry['files']
+            else self.pkgs.get(pkgname, pkginfo)
+            for pkgname, pkginfo in resulting_pkgs.items()
+        }
 
-    def build(self, pkgroot, pkgcache=None, jobs=None):
-        click.echo('{0}: starting build'.format(self.fullname))
+        # show new packages, that did not exist before
+        new = [pkgname for pkgname in resulting_pkgs.keys()
+               if pkgname not in self.pkgs]
+        if new:
+            click.echo('  new:')
+            for pkgname in new:
+                click.echo('    - {0} ({1})'.format(
+                    pkgname, resulting_pkgs[pkgname]['version']
+                ))
+
+        # show upgraded packages, where the version string changed
+        upgraded = [
+            pkgname for pkgname, pkginfo in resulting_pkgs.items()
+            if pkgname in self.pkgs
+            and self.pkgs[pkgname]['version'] != pkginfo['version']
+        ]
+        if upgraded:
+            click.echo('  upgraded:')
+            for pkgname in upgraded:
+                click.echo('    - {0} ({1} → {2})'.format(
+                    pkgname,
+                    self.pkgs[pkgname]['version'],
+                    resulting_pkgs[pkgname]['version'],
+                ))
+
+        # show old packages that were not rebuilt
+        # TODO: remove these packages from the repository
+        dangling = [
+            pkgname for pkgname in self.pkgs.keys()
+            if pkgname not in resulting_pkgs
+        ]
+        if dangling:
+            click.echo('  dangling:')
+            for pkgname in dangling:
+                click.echo(
+                    '    - {0} ({1}): {2}'.format(
+                        pkgname,
+                        self.pkgs[pkgname]['version'],
+                        self.pkgs[pkgname]['file']
+                    )
+                )
 
-        timestamp = '{:%H-%M-%s}'.format(datetime.datetime.now())
+        self.commit = entry['commit']
+        self.updated = int(time.time())
+        self.pkgs = resulting_pkgs
+        self.failures = None
+        self.durations = (self.durations + [
+            entry['duration']
+        ])[-self.duration_history:]
+
+        # only recorded now, so any save that drops the journal entry
+        # already writes the state above. Adding again after an interruption
+        # before this point is harmless.
+        if entry['stage'] != STAGE_ADDED:
+            journal.record(self.name, STAGE_ADDED)
+
+        return True
 
+    def fetch(self, pkgroot, node):
+        # download the sources into pkgroot in a container of its own, while
+        # the build slots are busy with other packages
+        click.echo('{0}: fetching sources on {1}'.format(
+            self.fullname, node.name))
+
+        timestamp = '{:%H-%M-%s}'.format(datetime.datetime.now())
         volumes = {
             pkgroot:
                 {'bind': '/pkg', 'mode': 'rw'},
-            self.repository.basedir:
-                {'bind': '/repo', 'mode': 'ro'},
-            PACMAN_SYNC_CACHE_DIR:
-                {'bind': '/var/lib/pacman/sync', 'mode': 'rw'},
         }
 
-        if pkgcache:
-            volumes[pkgcache] = {'bind': '/var/cache/pacman/pkg', 'mode': 'rw'}
-
-        client = docker.from_env()
-        try:
-            container = client.containers.run(
+        with tracer.span('prefetch', package=self.fullname, node=node.name):
+            container = node.run(
                 image=DOCKER_IMAGE,
                 command="/bin/sh -c "
                         "'usermod -u $USER_ID build &&"
-                        " su -c /build.sh build'",
-                name='{0}_build_{1}_{2}'.format(
+                        " su -c /fetch.sh build'",
+                name='{0}_fetch_{1}_{2}'.format(
                     PROJECT_NAME, self.name, timestamp),
-                detach=True,
                 environment={
                     "USER_ID": os.getuid(),
-                    "JOBS": jobs or os.cpu_count(),
-                    "REPO_NAME": self.repository.name,
                 },
-                volumes=volumes,
-                remove=True
+                volumes=volumes
             )
-        except requests.exceptions.ConnectionError as ex:
+
+            try:
+                success, reason = follow(
+                    container,
+                    timeout=self.timeouts.get('build'),
+                    stall_timeout=self.timeouts.get('stall')
+                )
+            finally:
+                node.collect(container, volumes)
+
+        if not success:
+            # not fatal, makepkg downloads whatever is missing on its own
             click.echo(
-                'Unable to start container, is the docker daemon running?\n'
-                '{0}'.format(ex),
+                '{0}: fetching sources failed{1}, leaving it to the '
+                'build'.format(
+                    self.fullname, ' ({0})'.format(reason) if reason else ''),
                 file=sys.stderr
             )
-            sys.exit(1)
 
-        for line in container.logs(stream=True):
-            print('\t{0}'.format(line.decode().rstrip('\n')))
+        return success
+
+    def is_unchanged(self, pkgname, pkginfo):
+        # same file with the same contents as the one in the repository
+        published = self.pkgs.get(pkgname)
+        if not published or not published.get('hash'):
+            return False
+
+        return published['file'] == pkginfo['file'] \
+            and published['hash'] == pkginfo['hash'] \
+            and os.path.exists(os.path.join(
+                self.repository.basedir, published['file']))
+
+    def build(self, pkgroot, node=None, pkgcache=None, jobs=None,
+              syncdir=None):
+        if not node:
+            node = BuildNode('local')
+
+        click.echo('{0}: starting build on {1}'.format(
+            self.fullname, node.name))
+
+        timestamp = '{:%H-%M-%s}'.format(datetime.datetime.now())
+
+        # remote nodes only get the database and the packages the build may
+        # install from the repository, and only ship the results back
+        volumes = {
+            pkgroot:
+                {'bind': '/pkg', 'mode': 'rw'},
+            self.repository.basedir:
+                {'bind': '/repo', 'mode': 'ro',
+                 'include': ['{0}.db'.format(self.repository.name)]
+                 + self.get_repository_dependencies()},
+        }
+        artifacts = ''
+        if not node.local:
+            artifacts = '/home/build/artifacts'
+            volumes[pkgroot]['collect'] = artifacts
+
+        # without a sync database snapshot the container refreshes on its own
+        if syncdir:
+            volumes[syncdir] = {'bind': '/sync', 'mode': 'ro'}
+
+        # keys to verify the sources with come from the shared keyring
+        if self.get_srcinfo_values(pkgroot, ('validpgpkeys',)):
+            volumes[PGP_KEYRING_DIR] = {'bind': '/keyring', 'mode': 'ro'}
+
+        if not jobs:
+            jobs = os.cpu_count() if node.local \
+                else node.client.info()['NCPU']
+
+        with tracer.span('dependency image', package=self.fullname,
+                         node=node.name):
+            image = dependency_image(
+                node,
+                self.get_dependencies(pkgroot),
+                syncdir=syncdir,
+                pkgcache=pkgcache
+            )
+
+        with package_cache(pkgcache if node.local else None) as caches:
+            with tracer.span('container start', package=self.fullname,
+                             node=node.name):
+                container = node.run(
+                    image=image,
+                    command="/bin/sh -c "
+                            "'usermod -u $USER_ID build &&"
+                            " su -c /build.sh build'",
+                    name='{0}_build_{1}_{2}'.format(
+                        PROJECT_NAME, self.name, timestamp),
+                    environment={
+                        "USER_ID": os.getuid(),
+                        "JOBS": jobs,
+                        "REPO_NAME": self.repository.name,
+                        "PKGEXT": self.compression.get('pkgext', ''),
+                        "COMPRESS_LEVEL": self.compression.get('level', ''),
+                        "COMPRESS_THREADS": self.compression.get('threads', ''),
+                        "KEYSERVER": PGP_KEYSERVER,
+                        "ARTIFACTS": artifacts,
+                    },
+                    volumes=volumes,
+                    caches=caches
+                )
 
-        return container.wait()['StatusCode'] == 0
+            tail = deque(maxlen=self.failure_log_lines)
+            try:
+                with tracer.span('makepkg', package=self.fullname,
+                                 node=node.name):
+                    success, self.build_error = follow(
+                        container, tail,
+                        timeout=self.timeouts.get('build'),
+                        stall_timeout=self.timeouts.get('stall')
+                    )
+                    return success
+            finally:
+                self.build_log = list(tail)
+
+                # only the resulting packages are shipped back from remote nodes
+                with tracer.span('collect', package=self.fullname,
+                                 node=node.name):
+                    node.collect(container, volumes, include=lambda name: (
+                        name == '.compression'
+                        or fnmatch(name, self.pkg_pattern)))
+
+    def get_repository_dependencies(self):
+        # files of the published packages this package depends on, directly
+        # or indirectly
+        deps = dependencies(self.repository.packages | {self})
+        return sorted(
+            pkginfo['file']
+            for pkg in required(deps, self)
+            for pkginfo in pkg.pkgs.values()
+        )
 
     @staticmethod
-    def get_pkg_names(pkgroot):
-        def pkgname_from_pkgfile(pkgfile):
-            # open pkg.tar.* file and read metadata from .PKGINFO file
-            with tarfile.open(pkgfile, 'r') as tar:
-                # find pkgname and pkgver
-                with TemporaryDirectory(prefix='srcinfo') as tempdir:
-                    tar.extract('.PKGINFO', tempdir)
-                    with open(os.path.join(tempdir, '.PKGINFO')) as handle:
-                        pkgname = pkgver = None
-                        for line in handle.readlines():
+    def get_srcinfo_values(pkgroot, keys):
+        # read the values of all given keys from .SRCINFO
+        values = set()
+        try:
+            with open(os.path.join(pkgroot, '.SRCINFO')) as handle:
+                for line in handle.readlines():
+                    try:
+                        k, v = line.split('=', 1)
+                        k = k.strip()
+                        v = v.strip()
+                    except ValueError:
+                        continue
+
+                    if k in keys:
+                        values.add(v)
+        except FileNotFoundError:
+            return set()
+
+        return values
+
+    @staticmethod
+    def get_srcinfo_depends(pkgroot):
+        # read all dependencies required for the build from .SRCINFO
+        keys = ('depends', 'makedepends', 'checkdepends')
+        keys += tuple('{0}_x86_64'.format(key) for key in keys)
+
+        return Package.get_srcinfo_values(pkgroot, keys)
+
+    def get_dependencies(self, pkgroot):
+        # dependencies that can be preinstalled from the official
+        # repositories, packages served from our own repository change with
+        # every build
+        provided = set()
+        for pkg in self.repository.packages:
+            provided.add(pkg.name)
+            provided.update(pkg.pkgs.keys())
+
+        return {
+            dep for dep in self.get_srcinfo_depends(pkgroot)
+            if re.split('[<>=]', dep)[0] not in provided
+        }
+
+    @staticmethod
+    def get_pkg_names(pkgroot, pattern='*.pkg.tar*'):
+        def pkginfo_from_pkgfile(pkgfile):
+            # open pkg.tar.* file and read metadata from .PKGINFO file, that
+            # makepkg puts first into the archive. The package is hashed,
+            # leaving out what records the build itself, so identical
+            # rebuilds can be told apart from updates, including those that
+            # only change metadata like depends.
+            pkginfo = {}
+            digest = hashlib.sha256()
+            with open_pkgfile(pkgfile) as tar:
+                for member in tar:
+                    if member.name == '.PKGINFO':
+                        handle = tar.extractfile(member)
+                        for line in handle.read().decode().splitlines():
                             try:
-                                k, v = line.split('=')
+                                k, v = line.split('=', 1)
                                 k = k.strip()
                                 v = v.strip()
                             except ValueError:
                                 continue
 
-                            if k == 'pkgname':
-                                pkgname = v
-                            elif k == 'pkgver':
-                                pkgver = v
-                        return pkgname, pkgver
+                            pkginfo.setdefault(k, v)
+                            if not k.startswith('#') \
+                                    and k not in ('builddate', 'packager'):
+                                digest.update('{0}={1}\n'.format(
+                                    k, v).encode())
+                        continue
+
+                    if member.name in ('.BUILDINFO', '.MTREE'):
+                        continue
+
+                    digest.update('{0}\0{1}\0{2:o}\0{3}\0'.format(
+                        member.name, member.type.decode(), member.mode,
+                        member.linkname).encode())
+                    if member.isfile():
+                        handle = tar.extractfile(member)
+                        for chunk in iter(lambda: handle.read(65536), b''):
+                            digest.update(chunk)
+            return pkginfo, digest.hexdigest()
 
         # use globbing to find packages in pkgroot
         resulting_pkgs = {}
-        for pkgfile in Path(pkgroot).glob('*.pkg.tar*'):
+        for pkgfile in Path(pkgroot).glob(pattern):
             pkgfile = str(pkgfile)
 
             if pkgfile.endswith('.sig'):
                 # skip signature files
                 continue
 
-            pkgname, pkgver = pkgname_from_pkgfile(pkgfile)
-            resulting_pkgs[pkgname] = {
-                'version': pkgver,
-                'file': os.path.basename(pkgfile)
+            pkginfo, digest = pkginfo_from_pkgfile(pkgfile)
+            resulting_pkgs[pkginfo['pkgname']] = {
+                'version': pkginfo['pkgver'],
+                'file': os.path.basename(pkgfile),
+                'hash': digest,
+                'isize': int(pkginfo.get('size', 0)),
+                'csize': os.path.getsize(pkgfile),
             }
 
         return resulting_pkgs
+
+    @staticmethod
+    def get_compression_time(pkgroot):
+        # seconds spent in the compressor, as recorded by the build container
+        try:
+            with open(os.path.join(pkgroot, '.compression')) as handle:
+                return sum(
+                    float(end) - float(start) for start, end in (
+                        line.split() for line in handle.readlines()
+                        if line.strip())
+                )
+        except (FileNotFoundError, ValueError):
+            return None
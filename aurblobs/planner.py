@@ -0,0 +1,110 @@
+import heapq
+import statistics
+
+# assumed build duration in seconds of packages without build history
+DEFAULT_DURATION = 600
+
+
+def estimate(pkg):
+    # median of the recent successful builds, robust against the odd build
+    # that waited for a slow mirror
+    if not pkg.durations:
+        return DEFAULT_DURATION
+    return statistics.median(pkg.durations)
+
+
+def dependencies(pkgs):
+    # map every package to the packages among pkgs it needs to be built
+    # before, as recorded with their last build attempt
+    provided = {}
+    for pkg in pkgs:
+        provided[(pkg.repository.name, pkg.name)] = pkg
+        for pkgname in pkg.pkgs.keys():
+            provided[(pkg.repository.name, pkgname)] = pkg
+
+    deps = {}
+    for pkg in pkgs:
+        deps[pkg] = set()
+        for dep in pkg.depends:
+            other = provided.get((pkg.repository.name, dep))
+            if other is not None and other is not pkg:
+                deps[pkg].add(other)
+    return deps
+
+
+def required(deps, pkg):
+    # all packages pkg needs to be built before, directly or indirectly
+    seen = set()
+    pending = [pkg]
+    while pending:
+        for dep in deps[pending.pop()]:
+            if dep not in seen:
+                seen.add(dep)
+                pending.append(dep)
+    seen.discard(pkg)
+    return seen
+
+
+def depends_on(deps, pkg, other):
+    # whether other has to be built before pkg, directly or indirectly
+    return other in required(deps, pkg)
+
+
+def order(pkgs):
+    # longest processing time first, extended to dependencies: a package is
+    # ranked by the longest chain of builds starting with it, and only
+    # scheduled once everything it depends on is scheduled
+    pkgs = list(pkgs)
+    deps = dependencies(pkgs)
+
+    dependents = {pkg: set() for pkg in pkgs}
+    for pkg, required in deps.items():
+        for dep in required:
+            dependents[dep].add(pkg)
+
+    rank = {}
+
+    def chain(pkg):
+        if pkg not in rank:
+            # provisional value, that cuts dependency cycles short
+            rank[pkg] = estimate(pkg)
+            rank[pkg] = estimate(pkg) + max(
+                [chain(other) for other in dependents[pkg]], default=0)
+        return rank[pkg]
+
+    for pkg in pkgs:
+        chain(pkg)
+
+    ordered = []
+    remaining = set(pkgs)
+    while remaining:
+        # packages caught in a cycle are scheduled nevertheless
+        ready = [pkg for pkg in remaining if not deps[pkg] & remaining] \
+            or list(remaining)
+        pkg = min(ready, key=lambda p: (-rank[p], p.fullname))
+        ordered.append(pkg)
+        remaining.remove(pkg)
+
+    return ordered, deps
+
+
+def makespan(ordered, deps, parallel):
+    # simulate running the builds in order on parallel build slots, where
+    # a build waits for its dependencies to finish
+    slots = [0] * max(parallel, 1)
+    finished = {}
+    for pkg in ordered:
+        start = max([heapq.heappop(slots)] + [
+            finished[dep] for dep in deps[pkg] if dep in finished])
+        finished[pkg] = start + estimate(pkg)
+        heapq.heappush(slots, finished[pkg])
+
+    return max(finished.values(), default=0)
+
+
+def format_duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return '{0}h {1:02d}m'.format(hours, minutes)
+    return '{0}m {1:02d}s'.format(minutes, seconds)
@@ -1,24 +1,36 @@
 import json
 import os
 import sys
+import threading
+from contextlib import contextmanager
 from tempfile import TemporaryDirectory
-from shutil import rmtree
+from shutil import copyfileobj, rmtree
 
-import datetime
-import docker
-import requests
 from pkg_resources import parse_version
 
 import click
 from pretty_bad_protocol import gnupg
 
-from .constants import CONFIG_DIR, CACHE_DIR, DOCKER_IMAGE, PROJECT_NAME
+from .constants import CONFIG_DIR, CACHE_DIR
+from .database import RepositoryDatabase
+from .errors import RepositoryError
+from .journal import Journal
 from .package import Package
+from .trace import tracer
+from .utils import atomic_json_dump, atomic_write, file_lock
 
 
 class Repository:
     vcs_rebuild_age = 7 * 86400
 
+    # failed builds are retried after an exponentially growing delay
+    failure_backoff = 3600
+    failure_backoff_max = 7 * 86400
+
+    # builds are killed after running for too long or without any output
+    build_timeout = 6 * 3600
+    stall_timeout = 3600
+
     def __init__(self, name=None):
         try:
             self.name = name.lower()
@@ -27,6 +39,21 @@ class Repository:
         self.basedir = None
         self.packages = set()
 
+        # pkgext, level and threads passed to makepkg
+        self.compression = {}
+
+        # build and stall timeouts overriding the defaults
+        self.timeouts = {}
+
+        # serializes publishing and saving between concurrent builds
+        self.lock = threading.Lock()
+
+        # progress of the current update run
+        self.journal = Journal(self.name)
+
+        # gpg with the signing key imported
+        self._signer = None
+
         if name:
             self.load()
 
@@ -39,11 +66,28 @@ class Repository:
     def signing_key_file(self):
         return os.path.join(CONFIG_DIR, '{0}.gpg'.format(self.name))
 
-    def create(self, name, basedir, mail):
-        timestamp = '{:%H-%M-%s}'.format(datetime.datetime.now())
+    def signing_keyring_dir(self):
+        return os.path.join(CONFIG_DIR, '{0}.gnupg'.format(self.name))
+
+    def lock_file(self, kind):
+        return os.path.join(CACHE_DIR, '{0}.{1}.lock'.format(self.name, kind))
+
+    def updating(self, blocking=False):
+        # held for the duration of an update run, so runs of multiple
+        # processes don't build the same packages at the same time
+        return file_lock(self.lock_file('update'), blocking)
+
+    @contextmanager
+    def publishing(self):
+        # held while writing to the basedir, configuration or state, both
+        # between threads and between processes
+        with self.lock, file_lock(self.lock_file('publish')):
+            yield
 
+    def create(self, name, basedir, mail):
         self.name = name.lower()
         self.basedir = basedir
+        self.journal = Journal(self.name)
 
         # verify name is not taken
         if os.path.exists(self.config_file()) \
@@ -103,54 +147,25 @@ class Repository:
             with open(self.signing_key_file(), 'w') as handle:
                 handle.write(gpg.export_keys(key, True))
 
+            # don't sign with the key of a dropped repository of that name
+            rmtree(self.signing_keyring_dir(), ignore_errors=True)
+
         # initialize the empty repository
-        volumes = {
-            self.signing_key_file():
-                {'bind': '/privkey.gpg', 'mode': 'ro'},
-            self.basedir:
-                {'bind': '/repo', 'mode': 'rw'},
-        }
-
-        client = docker.from_env()
         try:
-            container = client.containers.run(
-                image=DOCKER_IMAGE,
-                entrypoint="/bin/sh -c "
-                           "'usermod -u $USER_ID build && "
-                           " su -c /init.sh build'",
-                name='{0}_sign_{1}_{2}'.format(
-                    PROJECT_NAME, self.name, timestamp),
-                detach=True,
-                environment={
-                    "USER_ID": os.getuid(),
-                    "REPO_NAME": self.name,
-                },
-                volumes=volumes,
-                remove=True
-            )
-        except requests.exceptions.ConnectionError as ex:
+            RepositoryDatabase(self.basedir, self.name).write(sign=self.sign)
+        except RepositoryError as ex:
             click.echo(
-                'Unable to start container, is the docker daemon '
-                'running?\n{0}'.format(ex),
+                "There were errors while initializing repository '{0}': "
+                "{1}".format(self.name, ex),
                 file=sys.stderr
             )
             sys.exit(1)
 
-        for line in container.logs(stream=True):
-            print('\t{0}'.format(line.decode().rstrip('\n')))
-
-        if container.wait()['StatusCode'] == 0:
-            # persist configuration
-            self.save()
-            click.echo(
-                "Repository successfully initialized."
-            )
-        else:
-            click.echo(
-                "There were errors while initializing repository '{0}'.".format(self.name),
-                file=sys.stderr
-            )
-            sys.exit(1)
+        # persist configuration
+        self.save()
+        click.echo(
+            "Repository successfully initialized."
+        )
 
     def drop(self):
         try:
@@ -180,6 +195,9 @@ class Repository:
                 file=sys.stderr
             )
 
+        self.journal.clear()
+        rmtree(self.signing_keyring_dir(), ignore_errors=True)
+
         try:
             rmtree(self.basedir)
         except OSError as ex:
@@ -228,6 +246,9 @@ class Repository:
             sys.exit(1)
 
         self.basedir = config['basedir']
+        self.compression = config.get('compression', {})
+        self.timeouts = config.get('timeouts', {})
+        pkgoptions = config.get('pkgoptions', {})
 
         for package in config['pkgs']:
             try:
@@ -241,11 +262,22 @@ class Repository:
                     name=package,
                     commit=pkgstate.get('commit', None),
                     pkgs=pkgstate.get('pkgs', None),
-                    updated=pkgstate.get('updated', None)
+                    updated=pkgstate.get('updated', None),
+                    depends=pkgstate.get('depends', None),
+                    failures=pkgstate.get('failures', None),
+                    durations=pkgstate.get('durations', None),
+                    options=pkgoptions.get(package, None)
                 )
             )
 
-    def save(self):
+    def save(self, config=True, state=True, packages=None):
+        # only write what was changed, to not revert changes other processes
+        # made in the meantime. With packages, only the state of the named
+        # packages is written, the rest is kept as found on disk.
+        with self.publishing(), tracer.span('save', repository=self.name):
+            self._save(config, state, packages)
+
+    def _save(self, config, state, packages):
         class ConfigEncoder(json.JSONEncoder):
             def default(self, o):
                 if isinstance(o, Package):
@@ -254,27 +286,64 @@ class Repository:
 
         # render config and state before opening their file for writing or else
         # there is a risk of truncation.
-        config = {
-            'basedir': self.basedir,
-            'pkgs': list(self.packages)
-        }
-
-        state = {
-            'pkgs': {
-                pkg.name: {
-                    'commit': pkg.commit,
-                    'updated': pkg.updated,
-                    'pkgs': {
-                        pkgname: pkgver for pkgname, pkgver in pkg.pkgs.items()
-                    }
-                } for pkg in self.packages}
-        }
-
-        with open(self.config_file(), 'w') as handle:
-            json.dump(config, handle, indent=2, cls=ConfigEncoder)
-
-        with open(self.state_file(), 'w') as handle:
-            json.dump(state, handle, indent=2)
+        if config:
+            config = {
+                'basedir': self.basedir,
+                'pkgs': list(self.packages)
+            }
+            if self.compression:
+                config['compression'] = self.compression
+            if self.timeouts:
+                config['timeouts'] = self.timeouts
+
+            pkgoptions = {
+                pkg.name: pkg.options for pkg in self.packages if pkg.options
+            }
+            if pkgoptions:
+                config['pkgoptions'] = pkgoptions
+
+        if state:
+            # packages recorded as added before rendering the state have
+            # their results in it, unless their state is kept from disk
+            added = [pkgname for pkgname in self.journal.added()
+                     if packages is None or pkgname in packages]
+
+            state = {
+                'pkgs': {
+                    pkg.name: {
+                        'commit': pkg.commit,
+                        'updated': pkg.updated,
+                        'pkgs': {
+                            pkgname: pkgver
+                            for pkgname, pkgver in pkg.pkgs.items()
+                        },
+                        'depends': pkg.depends,
+                        'failures': pkg.failures,
+                        'durations': pkg.durations
+                    } for pkg in self.packages}
+            }
+
+            if packages is not None:
+                try:
+                    with open(self.state_file()) as handle:
+                        saved = json.load(handle).get('pkgs', {})
+                except (FileNotFoundError, json.decoder.JSONDecodeError):
+                    saved = {}
+
+                state['pkgs'] = {
+                    name: pkgstate if name in packages else saved[name]
+                    for name, pkgstate in state['pkgs'].items()
+                    if name in packages or name in saved
+                }
+
+        if config:
+            atomic_json_dump(
+                config, self.config_file(), indent=2, cls=ConfigEncoder)
+
+        if state:
+            atomic_json_dump(state, self.state_file(), indent=2)
+
+            self.journal.collect(added)
 
     def add(self, pkgname):
         # check if pkg already configured
@@ -303,9 +372,23 @@ class Repository:
             )
             sys.exit(1)
 
-        # add package to repository
+        # add package to repository, it has no state yet
         self.packages.add(pkg)
-        self.save()
+        self.save(state=False)
+
+    def failed_dependencies(self, pkg):
+        # dependencies of pkg that are served by packages failing to build.
+        # A failed forced rebuild of the published PKGBUILD leaves the
+        # published packages in place, those don't count.
+        failed = set()
+        for other in self.packages:
+            if other is pkg or not other.failures \
+                    or other.failures['commit'] == other.commit:
+                continue
+            failed.add(other.name)
+            failed.update(other.pkgs.keys())
+
+        return failed.intersection(pkg.depends)
 
     def find_package(self, pkgname):
         try:
@@ -320,47 +403,102 @@ class Repository:
             )
             sys.exit(1)
 
-    def sign_and_add(self, pkgroot):
-        timestamp = '{:%H-%M-%s}'.format(datetime.datetime.now())
+    def signer(self):
+        # keyring with the signing key imported once, instead of importing
+        # it into a blank keyring for every signature
+        if not self._signer:
+            os.makedirs(self.signing_keyring_dir(), mode=0o700, exist_ok=True)
+            gpg = gnupg.GPG(homedir=self.signing_keyring_dir())
+            if not gpg.list_keys(secret=True):
+                with open(self.signing_key_file()) as handle:
+                    gpg.import_keys(handle.read())
+            self._signer = gpg
+        return self._signer
+
+    def sign(self, path):
+        # create a detached signature next to the file with the host gpg
+        with open(path, 'rb') as handle:
+            signature = self.signer().sign(
+                handle, detach=True, binary=True, clearsign=False)
+
+        if not signature.data:
+            raise RepositoryError(
+                'Unable to sign {0}: {1}'.format(path, signature.stderr))
+
+        with atomic_write('{0}.sig'.format(path), 'wb') as handle:
+            handle.write(signature.data)
+
+    def staging_file(self, filename):
+        # packages are signed under a temporary name, that keeps the
+        # extension, until they are added
+        return os.path.join(self.basedir, '.staged-{0}'.format(filename))
+
+    def sign_packages(self, pkgfiles):
+        # copy packages into the basedir and sign them, returns their
+        # filenames. They only replace the served files once they are added.
+        try:
+            with self.publishing():
+                filenames = []
+                for pkgfile in pkgfiles:
+                    filename = os.path.basename(pkgfile)
+                    target = self.staging_file(filename)
+                    with tracer.span('sign', package=filename):
+                        with open(pkgfile, 'rb') as src, \
+                                atomic_write(target, 'wb') as dst:
+                            copyfileobj(src, dst)
+                        self.sign(target)
+                    filenames.append(filename)
+        except OSError as ex:
+            click.echo(
+                '{0}: unable to sign packages: {1}'.format(self.name, ex),
+                file=sys.stderr
+            )
+            return None
 
-        volumes = {
-            pkgroot:
-                {'bind': '/pkg', 'mode': 'rw'},
-            self.signing_key_file():
-                {'bind': '/privkey.gpg', 'mode': 'ro'},
-            self.basedir:
-                {'bind': '/repo', 'mode': 'rw'},
-        }
+        return filenames
 
-        client = docker.from_env()
+    def add_packages(self, filenames):
+        # add signed packages in the basedir to the database
         try:
-            container = client.containers.run(
-                image=DOCKER_IMAGE,
-                entrypoint="/bin/sh -c "
-                           "'usermod -u $USER_ID build && "
-                           " su -c /sign.sh build'",
-                name='{0}_sign_{1}_{2}'.format(
-                    PROJECT_NAME, self.name, timestamp),
-                detach=True,
-                environment={
-                    "USER_ID": os.getuid(),
-                    "REPO_NAME": self.name,
-                },
-                volumes=volumes,
-                remove=True
-            )
-        except requests.exceptions.ConnectionError as ex:
+            with self.publishing():
+                db = RepositoryDatabase(self.basedir, self.name).load()
+
+                replaced = []
+                staged = {}
+                for filename in filenames:
+                    path = os.path.join(self.basedir, filename)
+                    source = self.staging_file(filename)
+                    if os.path.exists(source):
+                        staged[source] = path
+                        staged['{0}.sig'.format(source)] = \
+                            '{0}.sig'.format(path)
+                    else:
+                        # moved into place by an interrupted run already
+                        source = path
+                    with tracer.span('repo-add', package=filename):
+                        replaced.append(db.add(source, filename))
+
+                with tracer.span('repo-add', repository=self.name):
+                    db.write(sign=self.sign, staged=staged)
+
+                # drop package files that were replaced, like repo-add
+                # --remove would do, once the database no longer references
+                # them
+                for filename in filter(None, replaced):
+                    for path in (filename, '{0}.sig'.format(filename)):
+                        try:
+                            os.remove(os.path.join(self.basedir, path))
+                        except FileNotFoundError:
+                            pass
+        except (OSError, RepositoryError) as ex:
             click.echo(
-                'Unable to start container, is the docker daemon '
-                'running?\n{0}'.format(ex),
+                '{0}: unable to add packages to the repository: {1}'.format(
+                    self.name, ex),
                 file=sys.stderr
             )
-            sys.exit(1)
+            return False
 
-        for line in container.logs(stream=True):
-            print('\t{0}'.format(line.decode().rstrip('\n')))
-
-        return container.wait()['StatusCode'] == 0
+        return True
 
     def remove_and_sign(self, pkgname):
         pkg = self.find_package(pkgname)
@@ -369,59 +507,31 @@ class Repository:
 
         if not pkg.pkgs:
             self.packages.remove(pkg)
-            self.save()
+            self.save(packages=())
             click.echo(
                 "{0}: package {1} successfully removed.".format(
                     self.name, pkgname)
             )
             sys.exit(0)
 
-        timestamp = '{:%H-%M-%s}'.format(datetime.datetime.now())
-        volumes = {
-            self.signing_key_file():
-                {'bind': '/privkey.gpg', 'mode': 'ro'},
-            self.basedir:
-                {'bind': '/repo', 'mode': 'rw'},
-        }
-
-        client = docker.from_env()
         try:
-            container = client.containers.run(
-                image=DOCKER_IMAGE,
-                entrypoint="/bin/sh -c "
-                           "'usermod -u $USER_ID build && "
-                           " su -c /remove.sh build'",
-                name='{0}_sign_{1}_{2}'.format(
-                    PROJECT_NAME, self.name, timestamp),
-                detach=True,
-                environment={
-                    "USER_ID": os.getuid(),
-                    "REPO_NAME": self.name,
-                    "PKGNAMES": ' '.join(pkg.pkgs.keys())
-                },
-                volumes=volumes,
-                remove=True
-            )
-        except requests.exceptions.ConnectionError as ex:
+            with self.publishing(), \
+                    tracer.span('repo-remove', repository=self.name):
+                db = RepositoryDatabase(self.basedir, self.name).load()
+                for name in pkg.pkgs.keys():
+                    db.remove(name)
+                db.write(sign=self.sign)
+        except (OSError, RepositoryError) as ex:
             click.echo(
-                'Unable to start container, is the docker daemon '
-                'running?\n{0}'.format(ex),
+                "There were errors while removing '{0}': {1}".format(
+                    pkgname, ex),
                 file=sys.stderr
             )
             sys.exit(1)
 
-        for line in container.logs(stream=True):
-            print('\t{0}'.format(line.decode().rstrip('\n')))
-
-        if container.wait()['StatusCode'] == 0:
-            self.packages.remove(pkg)
-            self.save()
-            click.echo(
-                "Package successfully removed."
-            )
-        else:
-            click.echo(
-                "There were errors while removing '{0}'.".format(pkgname),
-                file=sys.stderr
-            )
-            sys.exit(1)
+        # keep the state a concurrent update saved for the other packages
+        self.packages.remove(pkg)
+        self.save(packages=())
+        click.echo(
+            "Package successfully removed."
+        )
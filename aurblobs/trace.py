@@ -0,0 +1,116 @@
+import cProfile
+import json
+import os
+import pstats
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+
+class Tracer:
+    # records spans in the Chrome Trace Event format, that can be loaded
+    # into chrome://tracing or https://ui.perfetto.dev
+    def __init__(self):
+        self.enabled = False
+        self.events = []
+        self.threads = {}
+        self.lock = threading.Lock()
+        self.origin = time.perf_counter()
+
+    def enable(self):
+        self.enabled = True
+        self.origin = time.perf_counter()
+
+    def _now(self):
+        return int((time.perf_counter() - self.origin) * 1000000)
+
+    def _tid(self):
+        # one track per thread, numbered in order of appearance
+        thread = threading.current_thread()
+        with self.lock:
+            if thread.ident not in self.threads:
+                tid = len(self.threads) + 1
+                self.threads[thread.ident] = tid
+                self.events.append({
+                    'name': 'thread_name',
+                    'ph': 'M',
+                    'pid': os.getpid(),
+                    'tid': tid,
+                    'args': {'name': thread.name},
+                })
+            return self.threads[thread.ident]
+
+    @contextmanager
+    def span(self, name, **args):
+        if not self.enabled:
+            yield
+            return
+
+        tid = self._tid()
+        start = self._now()
+        try:
+            yield
+        finally:
+            event = {
+                'name': name,
+                'cat': args.pop('cat', 'aurblobs'),
+                'ph': 'X',
+                'ts': start,
+                'dur': self._now() - start,
+                'pid': os.getpid(),
+                'tid': tid,
+                'args': args,
+            }
+            with self.lock:
+                self.events.append(event)
+
+    def save(self, path):
+        with self.lock:
+            events = list(self.events)
+
+        with open(path, 'w') as handle:
+            json.dump({
+                'traceEvents': events,
+                'displayTimeUnit': 'ms',
+            }, handle)
+
+
+class Profiler:
+    # cProfile only covers the thread it was enabled in, so every worker
+    # thread gets its own profile, that are merged in the end
+    def __init__(self):
+        self.enabled = False
+        self.profiles = []
+        self.lock = threading.Lock()
+
+    def enable(self):
+        self.enabled = True
+
+    @contextmanager
+    def thread(self):
+        if not self.enabled:
+            yield
+            return
+
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            with self.lock:
+                self.profiles.append(profile)
+
+    def dump(self, limit=40, stream=sys.stderr):
+        with self.lock:
+            profiles = list(self.profiles)
+        if not profiles:
+            return
+
+        stats = pstats.Stats(*profiles, stream=stream)
+        stats.sort_stats('cumulative').print_stats(limit)
+
+
+tracer = Tracer()
+profiler = Profiler()
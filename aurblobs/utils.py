@@ -0,0 +1,66 @@
+import fcntl
+import json
+import os
+from contextlib import contextmanager
+from tempfile import NamedTemporaryFile
+
+from .errors import LockError
+
+
+@contextmanager
+def atomic_write(path, mode='w'):
+    # write to a temporary file next to path and rename it into place, so
+    # readers either see the old or the new content, never a truncated file
+    handle = NamedTemporaryFile(
+        mode=mode, dir=os.path.dirname(path) or '.',
+        prefix='.{0}.'.format(os.path.basename(path)), delete=False)
+    try:
+        with handle:
+            yield handle
+            handle.flush()
+            os.fsync(handle.fileno())
+
+        # keep permissions of the file we replace
+        try:
+            os.chmod(handle.name, os.stat(path).st_mode & 0o7777)
+        except FileNotFoundError:
+            os.chmod(handle.name, 0o644)
+
+        os.replace(handle.name, path)
+    except BaseException:
+        try:
+            os.remove(handle.name)
+        except FileNotFoundError:
+            pass
+        raise
+
+
+def atomic_json_dump(obj, path, **kwargs):
+    with atomic_write(path) as handle:
+        json.dump(obj, handle, **kwargs)
+
+
+def atomic_symlink(target, path):
+    # replace path with a symlink to target in a single rename
+    tmp = '{0}.tmp'.format(path)
+    if os.path.lexists(tmp):
+        os.remove(tmp)
+    os.symlink(target, tmp)
+    os.replace(tmp, path)
+
+
+@contextmanager
+def file_lock(path, blocking=True, shared=False):
+    # advisory lock, that is released automatically when the process dies
+    with open(path, 'a') as handle:
+        try:
+            fcntl.flock(
+                handle, (fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+                | (0 if blocking else fcntl.LOCK_NB))
+        except BlockingIOError:
+            raise LockError('{0} is locked by another process'.format(path))
+
+        try:
+            yield
+        finally:
+            fcntl.flock(handle, fcntl.LOCK_UN)
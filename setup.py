@@ -25,7 +25,8 @@ required = [
     'GitPython',
     'pretty-bad-protocol>=3.1.1',
     'requests',
-    'pyxdg'
+    'pyxdg',
+    'zstandard'
 ]
 
 